@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import pickle
+import argparse
+
+# Runs as python benchmarks/banded_scaling.py from any directory, or as
+# python -m benchmarks.banded_scaling from the notebook directory: the notebook
+# directory holds the grammar and phylogeny packages and ./primaries
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from Bio import AlignIO
+from grammar.pcnf import PCNF
+from grammar.dense_cyk import Lattice_CYK
+from grammar.extend import column_term
+from phylogeny.tree import neighbor_joining_tree
+from phylogeny.pruning import get_columns_probability
+
+
+FAMILIES = ["RF00001", "RF00005", "RF00162", "RF01704", "RF01734", "RF01739", "RF02035"]
+
+
+# Alignment of `sequences` rows and `length` columns made by concatenating
+# the first rows of the bundled Rfam families, cycling through them
+def synthetic_alignment(length, sequences=5):
+    rows = [""] * sequences
+    family = 0
+    while len(rows[0]) < length:
+        alignment = AlignIO.read(f"./primaries/stockholms/{FAMILIES[family % len(FAMILIES)]}.stockholm.txt", "stockholm")
+        for s in range(sequences):
+            rows[s] += str(alignment[s].seq).upper().replace("T", "U")
+        family += 1
+
+    clean = lambda row: "".join(char if char in "ACGU" else "-" for char in row[:length])
+    return {f"Seq{s + 1}": clean(row) for s, row in enumerate(rows)}
+
+
+def load_parameters():
+    with open("./primaries/parameters/_combined/frequencies.pkl", "rb") as file:
+        single_frequencies, paired_frequencies, _, _ = pickle.load(file)
+    with open("./primaries/parameters/_combined/mutation_rate.pkl", "rb") as file:
+        single_rate_values, paired_rate_values = pickle.load(file)
+    pcfg = PCNF("./primaries/structure.cfg", "./primaries/parameters/_combined/structure.pcfg")
+    return single_frequencies, paired_frequencies, single_rate_values, paired_rate_values, pcfg
+
+
+# First-pass parse time of the lattice engine, full and banded, as the
+# alignment grows. The full parse is only run up to full_limit columns.
+def run(lengths, max_span, full_limit, start_ratio=0.19, accelerat_ratio=1.48):
+    single_frequencies, paired_frequencies, single_rate_values, paired_rate_values, pcfg = load_parameters()
+
+    results = []
+    for length in lengths:
+        alignment = synthetic_alignment(length)
+        tree = neighbor_joining_tree(alignment)
+        single, paired, leaf_order = get_columns_probability(
+            tree, single_frequencies, paired_frequencies, single_rate_values, paired_rate_values, alignment,
+            lazy_pairs=True,
+        )
+        sentence = " ".join(
+            column_term(tuple(alignment[name][i] for name in leaf_order)) for i in range(length)
+        )
+
+        row = {"length": length, "max_span": max_span}
+        for mode, span in (("banded", max_span), ("full", None)):
+            if mode == "full" and length > full_limit:
+                row[mode] = None
+                continue
+            parser = Lattice_CYK(pcfg, single, paired, max_span=span)
+            start = time.perf_counter()
+            prob, table = parser.sentence_prob(sentence, start_ratio, accelerat_ratio)
+            row[mode] = time.perf_counter() - start
+            row[f"{mode}_prob"] = prob
+
+        results.append(row)
+        full = f"{row['full']:9.2f}s" if row["full"] is not None else "        -"
+        print(f"{length:6d} columns  banded(W={max_span}) {row['banded']:9.2f}s  full {full}", flush=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banded vs full CYK scaling on synthetic alignments")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[250, 500, 1000, 2000, 4000])
+    parser.add_argument("--max-span", type=int, default=150)
+    parser.add_argument("--full-limit", type=int, default=500)
+    args = parser.parse_args(argv)
+    os.chdir(ROOT)
+    run(args.lengths, args.max_span, args.full_limit)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
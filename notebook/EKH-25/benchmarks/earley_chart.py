@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+# Runs as python benchmarks/earley_chart.py from any directory, or as
+# python -m benchmarks.earley_chart from the notebook directory: the notebook
+# directory holds the grammar and phylogeny packages and ./primaries
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from grammar.pcnf import PCNF
+from grammar.ordered import Ordered
+
+
+NUCLEOTIDES = "acgu"
+
+
+# The structure grammar in the Ordered format: nonterminals keep their
+# rules and the emissions s (unpaired) and d (paired) become terminal
+# categories over the four nucleotides
+def structure_grammar(grammar_file="./primaries/structure.cfg", probablity_file="./primaries/parameters/_combined/structure.pcfg"):
+    pcfg = PCNF(grammar_file, probablity_file)
+    define_rules, probabilities = {}, {}
+    for A, B, C in pcfg.grammar.binary_rules:
+        define_rules.setdefault(A, []).append([B, C])
+        probabilities.setdefault(A, []).append([pcfg.q[(A, B, C)]])
+    for A, w in pcfg.grammar.unary_rules:
+        define_rules.setdefault(A, []).append([w])
+        probabilities.setdefault(A, []).append([pcfg.q[(A, w)]])
+        define_rules[w] = list(NUCLEOTIDES)
+        probabilities[w] = {nucleotide: 1 / len(NUCLEOTIDES) for nucleotide in NUCLEOTIDES}
+    return define_rules, probabilities
+
+
+class Legacy_Ordered(Ordered):
+    # The list-of-dicts Earley chart Ordered used before: every derivation
+    # is its own item and the best root is picked at the end
+
+    def predictor(self, rule, state):
+        current_symbol = rule["rhs"][rule["dot"]]
+        if current_symbol.isupper():
+            return [{
+                "lhs": current_symbol,
+                "rhs": rhs,
+                "dot": 0,
+                "state": state,
+                "end": state,
+                "op": "PREDICTOR",
+                "completor": [],
+                "probability": self.probabilities[current_symbol][i][0]
+            } for i, rhs in enumerate(self.define_rules[current_symbol])]
+        return []
+
+    def scanner(self, rule, next_input):
+        current_symbol = rule["rhs"][rule["dot"]]
+        if current_symbol.islower() and next_input in self.define_rules[current_symbol]:
+            return [{
+                "lhs": current_symbol,
+                "rhs": [next_input],
+                "dot": 1,
+                "state": rule["end"],
+                "end": rule["end"] + 1,
+                "op": "SCANNER",
+                "completor": [],
+                "probability": self.probabilities[current_symbol][next_input]
+            }]
+        return []
+
+    def completor(self, rule):
+        return [
+            {
+                "lhs": r["lhs"],
+                "rhs": r["rhs"],
+                "dot": r["dot"] + 1,
+                "state": r["state"],
+                "end": rule["end"],
+                "op": "COMPLETOR",
+                "completor": [rule] + r["completor"],
+                "probability": rule["probability"] * r["probability"]
+            }
+            for r in self.charts[rule["state"]]
+            if r["dot"] < len(r["rhs"]) and r["rhs"][r["dot"]] == rule["lhs"]
+        ]
+
+    def early_parser(self, sentence: str):
+        input_arr = sentence.split() + [""]
+        self.charts = [[{
+            "lhs": "ROOT",
+            "rhs": ["S"],
+            "dot": 0,
+            "state": 0,
+            "end": 0,
+            "op": "DUMMY",
+            "completor": [],
+            "probability": 1.0
+        }]]
+
+        for curr_state in range(len(input_arr)):
+            curr_chart = self.charts[curr_state]
+            next_chart = []
+
+            for curr_rule in curr_chart:
+                if curr_rule["dot"] < len(curr_rule["rhs"]):
+                    for pred_rule in self.predictor(curr_rule, curr_state):
+                        if pred_rule not in curr_chart:
+                            curr_chart.append(pred_rule)
+
+                    for scan_rule in self.scanner(curr_rule, input_arr[curr_state]):
+                        if scan_rule not in next_chart:
+                            next_chart.append(scan_rule)
+                else:
+                    for comp_rule in self.completor(curr_rule):
+                        if comp_rule not in curr_chart:
+                            curr_chart.append(comp_rule)
+
+            self.charts.append(next_chart)
+
+        return self.charts
+
+    def best_parse(self):
+        roots = [r for r in self.charts[-2] if r["lhs"] == "ROOT" and r["dot"] == len(r["rhs"])]
+        roots = sorted(roots, key=lambda root: root["probability"], reverse=True)
+        return roots[0] if roots else None
+
+
+# Nested (lhs, state, end, children) shape of a parse record
+def parse_shape(record):
+    return (record["lhs"], record["state"], record["end"], tuple(parse_shape(child) for child in record["completor"]))
+
+
+# Parse time of both charts on random nucleotide sentences of each length;
+# the legacy chart is only run up to legacy_limit words
+def run(lengths, legacy_limit, seed=0):
+    define_rules, probabilities = structure_grammar()
+    rng = random.Random(seed)
+
+    results = []
+    for length in lengths:
+        sentence = " ".join(rng.choice(NUCLEOTIDES) for _ in range(length))
+        row = {"length": length}
+        for name, parser in (("indexed", Ordered(define_rules, probabilities)), ("legacy", Legacy_Ordered(define_rules, probabilities))):
+            if name == "legacy" and length > legacy_limit:
+                row[name] = None
+                continue
+            start = time.perf_counter()
+            parser.early_parser(sentence)
+            best = parser.best_parse()
+            row[name] = time.perf_counter() - start
+            row[f"{name}_prob"] = best["probability"]
+            row[f"{name}_parse"] = parse_shape(best)
+
+        if row["legacy"] is not None:
+            row["same"] = row["legacy_prob"] == row["indexed_prob"] and row["legacy_parse"] == row["indexed_parse"]
+        results.append(row)
+
+        legacy = f"{row['legacy']:9.3f}s" if row["legacy"] is not None else "        -"
+        same = f"  same parse: {row['same']}" if "same" in row else ""
+        print(f"{length:5d} words  indexed {row['indexed']:9.3f}s  legacy {legacy}{same}", flush=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Indexed vs legacy Earley chart on the structure grammar")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[4, 6, 8, 10, 12, 50, 100, 200, 400])
+    parser.add_argument("--legacy-limit", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    os.chdir(ROOT)
+    run(args.lengths, args.legacy_limit, args.seed)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
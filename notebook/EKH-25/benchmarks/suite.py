@@ -0,0 +1,475 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+import numpy as np
+from Bio import AlignIO, Phylo
+
+# Runs as python benchmarks/suite.py from any directory, or as
+# python -m benchmarks.suite from the notebook directory: the notebook
+# directory holds the grammar and phylogeny packages and ./primaries
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from grammar.pcnf import PCNF
+from grammar.extend import extend_grammar, column_term
+from grammar.inside_outside import Array_Inside_Outside
+from grammar.dense_cyk import Lattice_CYK
+from grammar.ordered import Ordered
+from phylogeny.tree import neighbor_joining_tree
+from phylogeny.pruning import get_columns_probability, pair_cache
+from phylogeny.transition import transition_cache
+from phylogeny.columns import indexes
+from benchmarks.banded_scaling import synthetic_alignment, load_parameters
+from benchmarks.earley_chart import NUCLEOTIDES, structure_grammar
+
+
+# Hyperparameters of the notebooks' example prediction: first and second
+# start ratios, first and second accelerate ratios, flag ratio
+HYPERPARAMETERS = (0.19, 0.88, 1.48, 1.78, 0.98)
+OUTPUTS = "./outputs/benchmarks"
+PHYML = "./phyml"
+
+
+# Dot-bracket string of exactly length positions made of hairpins (stems of
+# 3-6 pairs around loops of 3-8) separated by short unpaired linkers; the
+# structure grammar derives every such string
+def synthetic_structure(length, rng):
+    structure = ""
+    while True:
+        linker = "." * rng.randint(0, 4)
+        stem = rng.randint(3, 6)
+        hairpin = "(" * stem + "." * rng.randint(3, 8) + ")" * stem
+        if len(structure) + len(linker) + len(hairpin) > length:
+            return structure + "." * (length - len(structure))
+        structure += linker + hairpin
+
+
+# Hairpin structure with exactly unpaired unpaired positions, so the
+# second-pass sentence has a controlled length whatever the pairs
+def flagged_structure(unpaired, rng):
+    structure, left = "", unpaired
+    while True:
+        linker, loop = rng.randint(0, 4), rng.randint(3, 8)
+        if linker + loop > left:
+            return structure + "." * left
+        stem = rng.randint(3, 6)
+        structure += "." * linker + "(" * stem + "." * loop + ")" * stem
+        left -= linker + loop
+
+
+# Structure grammar sentence of a dot-bracket string: d for paired and s
+# for unpaired positions
+def structure_sentence(structure):
+    return " ".join("s" if char == "." else "d" for char in structure)
+
+
+# Sentence and distinct columns of an alignment in leaf order, as
+# predict_structure builds them; with a first-pass structure its paired
+# positions become the "<" and ">" marks of the second pass
+def alignment_sentence(alignment, leaf_order, structure=None):
+    words, columns = [], {}
+    for i in range(len(alignment[leaf_order[0]])):
+        if structure is not None and structure[i] in "([{<":
+            words.append("<")
+        elif structure is not None and structure[i] in ")]}>":
+            words.append(">")
+        else:
+            column = tuple(alignment[name][i] for name in leaf_order)
+            columns[column] = True
+            words.append(column_term(column))
+    return " ".join(words), columns
+
+
+# The first leaves records of a bundled family (gaps kept, any other
+# non-nucleotide turned into a gap) and its stored tree pruned to them
+def family_alignment(family, leaves):
+    records = AlignIO.read(f"./primaries/phylips/{family}.phylip", "phylip-relaxed")[:leaves]
+    alignment = {
+        record.id: "".join(char if char in "ACGU" else "-" for char in str(record.seq).upper().replace("T", "U"))
+        for record in records
+    }
+    tree = Phylo.read(f"./primaries/trees/{family}.nwk", "newick")
+    for leaf in tree.get_terminals():
+        if leaf.name not in alignment:
+            tree.prune(leaf)
+    return alignment, tree
+
+
+# Every run starts from cold module-level caches, so repeats and machines
+# measure the same work
+def clear_caches():
+    transition_cache.clear()
+    pair_cache.clear()
+    indexes.clear()
+
+
+class Context:
+    # Inputs shared by the cases, loaded once per suite run
+    def __init__(self, seed):
+        self.seed = seed
+        (
+            self.single_frequencies,
+            self.paired_frequencies,
+            self.single_rate_values,
+            self.paired_rate_values,
+            self.pcfg,
+        ) = load_parameters()
+
+    def parameters(self):
+        return self.single_frequencies, self.paired_frequencies, self.single_rate_values, self.paired_rate_values
+
+    # Extended grammar and sentence of a synthetic alignment whose sentence
+    # has length words; with a structure its pairs are marked on top
+    def extended(self, length, structure=None):
+        alignment = synthetic_alignment(len(structure) if structure else length)
+        tree = neighbor_joining_tree(alignment)
+        single, paired, leaf_order = get_columns_probability(tree, *self.parameters(), alignment)
+        sentence, columns = alignment_sentence(alignment, leaf_order, structure)
+        return extend_grammar(columns, self.pcfg, single, paired), sentence
+
+
+# Each case turns a size into a zero-argument callable; building it is
+# not timed. A case that cannot run here (a missing external binary)
+# returns None and is skipped. Sizes are the default scaling points,
+# quick ones a smoke run.
+
+def sentence_prob_case(context, length):
+    pcfg, sentence = context.extended(length)
+    first_start, _, first_accelerat, _, _ = HYPERPARAMETERS
+    return lambda: pcfg.sentence_prob(sentence, first_start, first_accelerat)
+
+
+def flagged_sentence_prob_case(context, length):
+    pcfg, sentence = context.extended(length, flagged_structure(length, random.Random(context.seed)))
+    _, second_start, _, second_accelerat, flag = HYPERPARAMETERS
+    return lambda: pcfg.sentence_prob__(sentence, second_start, second_accelerat, flag)
+
+
+def inside_outside_case(context, length):
+    sentence = structure_sentence(synthetic_structure(length, random.Random(context.seed)))
+    return lambda: Array_Inside_Outside(sentence, context.pcfg.grammar, context.pcfg.q)
+
+
+# EM iterations from the trained probabilities over a corpus file
+def estimation(context, train_file, iterations):
+    pcfg = PCNF.from_rules(context.pcfg.grammar.cfg, context.pcfg.q.copy())
+    with contextlib.redirect_stdout(io.StringIO()):
+        return pcfg.estimate(train_file, iter_num=iterations)
+
+
+# One EM iteration over sentences distinct synthetic structures of 100
+# positions
+def estimate_case(context, sentences):
+    rng = random.Random(context.seed)
+    corpus = "".join(structure_sentence(synthetic_structure(100, rng)) + "\n" for _ in range(sentences))
+
+    def run():
+        with tempfile.NamedTemporaryFile("w", suffix=".train") as file:
+            file.write(corpus)
+            file.flush()
+            estimation(context, file.name, 1)
+    return run
+
+
+def estimate_train_case(context, iterations):
+    return lambda: estimation(context, "./primaries/parameters/_combined/structures.train", iterations)
+
+
+# Column likelihoods of a bundled family's first leaves on its stored tree
+# (the post-order traversal of predict_structure)
+def post_order_case(context, leaves, family="RF00005"):
+    alignment, tree = family_alignment(family, leaves)
+    return lambda: get_columns_probability(tree, *context.parameters(), alignment)
+
+
+# Tree of a bundled family's first leaves from the in-process neighbor
+# joining of create_tree(builder="native")
+def native_tree_case(context, leaves, family="RF00005"):
+    alignment, _ = family_alignment(family, leaves)
+    return lambda: neighbor_joining_tree(alignment)
+
+
+# Whether the phyml binary the notebooks call runs on this machine
+def phyml_available(binary=PHYML):
+    try:
+        subprocess.run([binary, "--version"], capture_output=True, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return True
+
+
+# The same tree from the phyml subprocess of create_tree(builder="phyml"),
+# run in a temporary directory; skipped where phyml does not run
+def phyml_tree_case(context, leaves, family="RF00005"):
+    if not phyml_available():
+        return None
+    alignment, _ = family_alignment(family, leaves)
+    binary = os.path.abspath(PHYML)
+
+    def run():
+        with tempfile.TemporaryDirectory() as directory:
+            phylip = os.path.join(directory, "sequences.phylip")
+            with open(phylip, "w") as file:
+                file.write(f"{len(alignment)} {len(next(iter(alignment.values())))}\n\n")
+                for name, sequence in alignment.items():
+                    file.write(f"{name}\t{sequence}\n")
+            subprocess.run([binary, "-i", phylip, "-m", "GTR"], cwd=directory, capture_output=True, check=True)
+            return Phylo.read(phylip + "_phyml_tree.txt", "newick")
+    return run
+
+
+# First-pass lattice parse of a synthetic alignment limited to pairs of at
+# most max_span columns (benchmarks/banded_scaling.py without the full
+# parse it is compared against there)
+def banded_case(context, length, max_span=150):
+    alignment = synthetic_alignment(length)
+    tree = neighbor_joining_tree(alignment)
+    single, paired, leaf_order = get_columns_probability(tree, *context.parameters(), alignment, lazy_pairs=True)
+    sentence, _ = alignment_sentence(alignment, leaf_order)
+    first_start, _, first_accelerat, _, _ = HYPERPARAMETERS
+    return lambda: Lattice_CYK(context.pcfg, single, paired, max_span=max_span).sentence_prob(sentence, first_start, first_accelerat)
+
+
+# Earley parse and best root of a random nucleotide sentence under the
+# structure grammar (benchmarks/earley_chart.py without the legacy chart)
+def earley_case(context, length):
+    define_rules, probabilities = structure_grammar()
+    rng = random.Random(context.seed)
+    sentence = " ".join(rng.choice(NUCLEOTIDES) for _ in range(length))
+
+    def run():
+        parser = Ordered(define_rules, probabilities)
+        parser.early_parser(sentence)
+        return parser.best_parse()
+    return run
+
+
+# predict_structure on a synthetic alignment with the in-process tree and
+# the dict engine, from tree building to the second-pass parse
+def predict_case(context, length):
+    alignment = synthetic_alignment(length)
+    first_start, second_start, first_accelerat, second_accelerat, flag = HYPERPARAMETERS
+
+    def run():
+        tree = neighbor_joining_tree(alignment)
+        single, paired, leaf_order = get_columns_probability(tree, *context.parameters(), alignment)
+        sentence, columns = alignment_sentence(alignment, leaf_order)
+        prob, table = extend_grammar(columns, context.pcfg, single, paired).sentence_prob(sentence, first_start, first_accelerat)
+        structure = table.structure(1, length)
+        sentence, columns = alignment_sentence(alignment, leaf_order, structure)
+        pcfg = extend_grammar(columns, context.pcfg, single, paired)
+        return pcfg.sentence_prob__(sentence, second_start, second_accelerat, flag)
+    return run
+
+
+CASES = {
+    # name: (build, parameter, sizes, quick sizes)
+    "sentence_prob": (sentence_prob_case, "length", [10, 20, 30, 40], [10, 15]),
+    "sentence_prob__": (flagged_sentence_prob_case, "length", [20, 30, 40, 50], [15, 20]),
+    "inside_outside": (inside_outside_case, "length", [50, 100, 150, 200], [30, 50]),
+    "estimate": (estimate_case, "sentences", [2, 4, 8, 16], [1, 2]),
+    "estimate_train": (estimate_train_case, "iterations", [1, 2], [1]),
+    "post_order_traversal": (post_order_case, "leaves", [50, 100, 200, 400], [20, 40]),
+    "native_tree": (native_tree_case, "leaves", [25, 50, 100, 200], [10, 20]),
+    "phyml_tree": (phyml_tree_case, "leaves", [25, 50, 100, 200], [10, 20]),
+    "predict_structure": (predict_case, "length", [10, 20, 30], [10, 15]),
+    "banded_sentence_prob": (banded_case, "length", [250, 500, 1000], [100, 200]),
+    "earley_chart": (earley_case, "length", [25, 50, 100, 200], [10, 20]),
+}
+
+
+# Wall times of repeat runs, then the peak traced allocation of one more
+# run (tracing slows the kernels down, so it is kept out of the timings)
+def measure(run, repeat):
+    times = []
+    for _ in range(repeat):
+        clear_caches()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    clear_caches()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+# Slope of log(time) against log(size): about 3 for a cubic parse
+def scaling_exponent(points):
+    points = [(point["size"], point["median"]) for point in points if point["median"] > 0]
+    if len(points) < 2:
+        return None
+    sizes, medians = zip(*points)
+    return float(np.polyfit(np.log(sizes), np.log(medians), 1)[0])
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+    }
+
+
+def run_suite(cases, repeat=3, seed=0, quick=False, sizes=None):
+    context = Context(seed)
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": repeat,
+        "seed": seed,
+        "quick": quick,
+        "environment": environment(),
+        "cases": {},
+    }
+
+    for name in cases:
+        build, parameter, default_sizes, quick_sizes = CASES[name]
+        points = []
+        for size in sizes or (quick_sizes if quick else default_sizes):
+            random.seed(seed)
+            run = build(context, size)
+            if run is None:
+                print(f"{name:22s} {parameter} {size:5d}  skipped (not available here)", flush=True)
+                continue
+            times, peak = measure(run, repeat)
+            point = {
+                "size": size,
+                "times": times,
+                "median": float(np.median(times)),
+                "min": min(times),
+                "peak_bytes": peak,
+            }
+            points.append(point)
+            print(f"{name:22s} {parameter} {size:5d}  median {point['median']:9.4f}s  min {point['min']:9.4f}s  peak {peak / 2**20:9.2f} MiB", flush=True)
+
+        results["cases"][name] = {"parameter": parameter, "points": points, "exponent": scaling_exponent(points)}
+        exponent = results["cases"][name]["exponent"]
+        if exponent is not None:
+            print(f"{name:22s} time ~ {parameter}^{exponent:.2f}", flush=True)
+    return results
+
+
+# Points of current that are slower (or use more memory) than baseline by
+# more than the tolerance; differences under min_seconds / min_bytes are
+# noise and never flagged
+def compare(baseline, current, tolerance=0.25, memory_tolerance=0.25, min_seconds=0.01, min_bytes=2**20):
+    rows = []
+    for name, case in current["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        before = {point["size"]: point for point in baseline["cases"][name]["points"]}
+        for point in case["points"]:
+            if point["size"] not in before:
+                continue
+            old = before[point["size"]]
+            slower = point["median"] > old["median"] * (1 + tolerance) and point["median"] - old["median"] > min_seconds
+            larger = point["peak_bytes"] > old["peak_bytes"] * (1 + memory_tolerance) and point["peak_bytes"] - old["peak_bytes"] > min_bytes
+            rows.append({
+                "case": name,
+                "size": point["size"],
+                "time_ratio": point["median"] / old["median"] if old["median"] else float("inf"),
+                "memory_ratio": point["peak_bytes"] / old["peak_bytes"] if old["peak_bytes"] else float("inf"),
+                "regression": slower or larger,
+                "slower": slower,
+                "larger": larger,
+            })
+    return rows
+
+
+def print_comparison(baseline, current, rows):
+    if baseline["environment"] != current["environment"]:
+        print("warning: the baseline was recorded in a different environment", file=sys.stderr)
+    for row in rows:
+        flags = ", ".join(flag for flag, on in (("slower", row["slower"]), ("more memory", row["larger"])) if on)
+        print(f"{row['case']:22s} {row['size']:5d}  time x{row['time_ratio']:6.2f}  memory x{row['memory_ratio']:6.2f}  {'REGRESSION: ' + flags if flags else 'ok'}")
+    regressions = sum(row["regression"] for row in rows)
+    print(f"{regressions} regression(s) in {len(rows)} compared point(s)")
+    return regressions
+
+
+def load(filename):
+    with open(filename) as file:
+        return json.load(file)
+
+
+def save(results, filename):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Saved {filename}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the parsing, training and phylogenetic stages")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run cases and save the results as JSON")
+    run.add_argument("cases", nargs="*", help=f"cases to run (default: all of {', '.join(CASES)})")
+    run.add_argument("--sizes", type=int, nargs="+", help="sizes to run instead of each case's defaults")
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--quick", action="store_true", help="small sizes only, as a smoke test")
+    run.add_argument("--output", help=f"JSON file to write (default: {OUTPUTS}/<time>.json)")
+    run.add_argument("--baseline", help="compare against this result file after the run")
+    run.add_argument("--tolerance", type=float, default=0.25)
+    run.add_argument("--memory-tolerance", type=float, default=0.25)
+
+    check = commands.add_parser("compare", help="flag regressions of a result file against a baseline")
+    check.add_argument("baseline")
+    check.add_argument("current")
+    check.add_argument("--tolerance", type=float, default=0.25)
+    check.add_argument("--memory-tolerance", type=float, default=0.25)
+
+    commands.add_parser("list", help="list the cases and their default sizes")
+
+    args = parser.parse_args(argv)
+    for name in ("output", "baseline", "current"):
+        if getattr(args, name, None):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    os.chdir(ROOT)
+
+    if args.command == "list":
+        for name, (_, parameter, sizes, quick_sizes) in CASES.items():
+            print(f"{name:22s} {parameter:10s} {sizes}  quick {quick_sizes}")
+        return 0
+
+    if args.command == "run":
+        unknown = [name for name in args.cases if name not in CASES]
+        if unknown:
+            parser.error(f"unknown case(s): {', '.join(unknown)}")
+        current = run_suite(args.cases or list(CASES), args.repeat, args.seed, args.quick, args.sizes)
+        save(current, args.output or f"{OUTPUTS}/{time.strftime('%Y%m%d-%H%M%S')}.json")
+        if not args.baseline:
+            return 0
+        baseline = load(args.baseline)
+    else:
+        baseline, current = load(args.baseline), load(args.current)
+
+    rows = compare(baseline, current, args.tolerance, args.memory_tolerance)
+    return 1 if print_comparison(baseline, current, rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,36 @@
+import numpy as np
+
+
+class Bracket_Ranges:
+    # Bracket counts of any range of a sentence's "<" / ">" marks. With H
+    # the prefix sums of +1 per "<" and -1 per ">", a left-to-right scan of
+    # words[i..j] is left with max(0, H[i] - min H[i+1..j+1]) unmatched ">"
+    # and that plus H[j+1] - H[i] still open "<". The minimum is read from a
+    # sparse table, so the build is O(n log n) and every query O(1).
+    def __init__(self, words):
+        steps = [1 if w == "<" else -1 if w == ">" else 0 for w in words]
+        heights = np.concatenate(([0], np.cumsum(steps, dtype=np.int64)))
+        self.heights = heights.tolist()
+
+        # levels[p][t]: minimum of H[t+1 .. t+2^p]
+        levels = [heights[1:]]
+        while 2 ** len(levels) <= len(words):
+            half = 2 ** (len(levels) - 1)
+            levels.append(np.minimum(levels[-1][:-half], levels[-1][half:]))
+        self.levels = [level.tolist() for level in levels]
+
+    # Lowest height reached inside words[i..j] (0-based, inclusive)
+    def lowest(self, i, j):
+        p = (j - i + 1).bit_length() - 1
+        level = self.levels[p]
+        return min(level[i], level[j - 2 ** p + 1])
+
+    def mismatch(self, i, j):
+        return max(0, self.heights[i] - self.lowest(i, j))
+
+    def netopen(self, i, j):
+        return self.heights[j + 1] - self.heights[i] + self.mismatch(i, j)
+
+    # Unmatched ">" plus unmatched "<" of words[i..j]
+    def total(self, i, j):
+        return 2 * self.mismatch(i, j) + self.heights[j + 1] - self.heights[i]
@@ -2,8 +2,9 @@ from collections import defaultdict
 
 
 class CNF:
-    def __init__(self, grammar_file: str):
-        self.cfg = self.read_cfg_file(grammar_file)
+    def __init__(self, grammar_file: str, cfg=None):
+        # cfg, a list of (lhs, rhs) pairs, builds the grammar without a file
+        self.cfg = self.read_cfg_file(grammar_file) if cfg is None else list(cfg)
         self.nonterminals = self.get_noterminals()
         self.binary_rules = self.get_binary_rules()
         self.unary_rules = self.get_unary_rules()
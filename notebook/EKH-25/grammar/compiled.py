@@ -0,0 +1,104 @@
+import os
+import sys
+import pickle
+import numpy as np
+from collections import defaultdict
+from grammar.cnf import CNF
+
+
+def log(x):
+    from math import log
+    if x > 0: return log(x)
+    else: return float("-inf")
+
+
+class Compiled_Grammar:
+    # Integer-interned view of a CNF grammar and its rule probabilities,
+    # indexed for the lookups the parsers and the estimator need
+    def __init__(self, grammar: CNF, q: defaultdict):
+        self.index = {}
+        for X in grammar.nonterminals:
+            self.index.setdefault(X, len(self.index))
+        for A, B, C in grammar.binary_rules:
+            for X in (A, B, C):
+                self.index.setdefault(X, len(self.index))
+        for A, w in grammar.unary_rules:
+            self.index.setdefault(A, len(self.index))
+        self.symbols = list(self.index)
+
+        # Binary rules, parallel arrays in grammar.binary_rules order
+        self.parent = np.array([self.index[A] for A, B, C in grammar.binary_rules], dtype=np.int32)
+        self.left = np.array([self.index[B] for A, B, C in grammar.binary_rules], dtype=np.int32)
+        self.right = np.array([self.index[C] for A, B, C in grammar.binary_rules], dtype=np.int32)
+        self.logp = np.array([log(q.get(rule, 0)) for rule in grammar.binary_rules], dtype=np.float64)
+
+        self.by_left = defaultdict(list)
+        self.binary_by_lhs = defaultdict(list)
+        for r, (A, B, C) in enumerate(grammar.binary_rules):
+            self.by_left[self.index[B]].append(r)
+            self.binary_by_lhs[self.index[A]].append(r)
+
+        # Unary rules: terminal -> [(nonterminal id, logp)], in rule order
+        self.unary = defaultdict(list)
+        self.unary_by_lhs = defaultdict(list)
+        for r, (A, w) in enumerate(grammar.unary_rules):
+            self.unary[w].append((self.index[A], log(q.get((A, w), 0))))
+            self.unary_by_lhs[self.index[A]].append(r)
+
+
+# Binary cache stored next to the text grammar. It holds the parsed CNF,
+# the probabilities and the compiled index, and is only trusted while its
+# format version and the size and modification time of every source file,
+# grammar text and the modules of the pickled classes alike, still match.
+# Bump CACHE_VERSION whenever the cached objects change shape.
+CACHE_VERSION = 2
+
+
+def cache_path(grammar_file: str, probablity_file=""):
+    return (probablity_file or grammar_file) + ".cache"
+
+
+def file_stamps(*filenames):
+    stamps = []
+    for filename in filenames:
+        if filename:
+            stat = os.stat(filename)
+            stamps.append((os.path.abspath(filename), stat.st_size, stat.st_mtime_ns))
+    return stamps
+
+
+def code_stamps():
+    return file_stamps(__file__, sys.modules[CNF.__module__].__file__)
+
+
+def load_cache(grammar_file: str, probablity_file=""):
+    path = cache_path(grammar_file, probablity_file)
+    if not os.path.exists(path):
+        return None
+    # A cache written by other code may name classes or modules that no
+    # longer exist; it is rebuilt like a stale one
+    try:
+        with open(path, "rb") as file:
+            cached = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, TypeError):
+        return None
+    if not isinstance(cached, dict) or cached.get("version") != CACHE_VERSION:
+        return None
+    if cached.get("code") != code_stamps():
+        return None
+    if cached.get("stamps") != file_stamps(grammar_file, probablity_file):
+        return None
+    return cached
+
+
+def save_cache(grammar_file: str, probablity_file, grammar: CNF, q, compiled: Compiled_Grammar):
+    data = {
+        "version": CACHE_VERSION,
+        "code": code_stamps(),
+        "stamps": file_stamps(grammar_file, probablity_file),
+        "grammar": grammar,
+        "q": dict(q) if probablity_file else None,
+        "compiled": compiled,
+    }
+    with open(cache_path(grammar_file, probablity_file), "wb") as file:
+        pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
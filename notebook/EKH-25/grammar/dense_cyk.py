@@ -0,0 +1,435 @@
+import numpy as np
+from grammar.pcnf import PCNF
+from grammar.compiled import log
+from grammar.extend import column_term
+from grammar.traceback import Parse_Table, Packed_Table
+from profiling.counters import kernel_counters
+
+
+class Band_Chart:
+    # Chart arrays of a batch of K parses. A cell (i, j) no longer than W is
+    # stored by its span, band[:, i, j - i + 1]; the longer cells a banded
+    # parse builds all end at n and are stored in wide[:, i]. Without a
+    # maximum span W = n and every cell is in the band.
+    def __init__(self, K, n, W, N):
+        self.K = K
+        self.n = n
+        self.W = W
+
+        self.P = np.full((K, n + 2, W + 1, N), float("-inf"))
+        self.status = np.zeros((K, n + 2, W + 1, N), dtype=bool)
+        self.split = np.zeros((K, n + 2, W + 1, N), dtype=np.int32)
+        self.rule = np.zeros((K, n + 2, W + 1, N), dtype=np.int32)
+        # Whether the cell is reachable for any member of the batch
+        self.finite = np.zeros((n + 2, W + 1, N), dtype=bool)
+
+        self.P_wide = np.full((K, n + 2, N), float("-inf"))
+        self.status_wide = np.zeros((K, n + 2, N), dtype=bool)
+        self.split_wide = np.zeros((K, n + 2, N), dtype=np.int32)
+        self.rule_wide = np.zeros((K, n + 2, N), dtype=np.int32)
+        self.finite_wide = np.zeros((n + 2, N), dtype=bool)
+
+    # Views of (P, status, split, rule, finite) over the nonterminals of (i, j)
+    def cell(self, i, j):
+        l = j - i + 1
+        if l <= self.W:
+            return self.P[:, i, l], self.status[:, i, l], self.split[:, i, l], self.rule[:, i, l], self.finite[i, l]
+        if j == self.n:
+            return self.P_wide[:, i], self.status_wide[:, i], self.split_wide[:, i], self.rule_wide[:, i], self.finite_wide[i]
+        return None
+
+    # Values of the cells (rows[m], rows[m] + spans[m] - 1), stacked on the
+    # axis before the nonterminals
+    def cells(self, band, wide, rows, spans):
+        narrow = spans <= self.W
+        if narrow.all():
+            return band[..., rows, spans, :]
+        values = np.empty(band.shape[:-3] + (len(rows), band.shape[-1]), dtype=band.dtype)
+        values[..., narrow, :] = band[..., rows[narrow], spans[narrow], :]
+        values[..., ~narrow, :] = wide[..., rows[~narrow], :]
+        return values
+
+    def score(self, k, i, j, A):
+        cell = self.cell(i, j)
+        return float(cell[0][k, A]) if cell is not None else float("-inf")
+
+
+class Dense_Table(Parse_Table):
+    # Read-only view over the (split, rule) backpointer arrays of one
+    # member k of a chart
+    def __init__(self, cyk, words, chart: Band_Chart, k=0):
+        self.cyk = cyk
+        self.words = words
+        self.chart = chart
+        self.k = k
+
+    def children(self, i, j, X):
+        if not (1 <= i <= j <= len(self.words)) or X not in self.cyk.index:
+            raise KeyError((i, j, X))
+
+        A = self.cyk.index[X]
+        cell = self.chart.cell(i, j)
+        if cell is None or cell[0][self.k, A] == float("-inf"):
+            raise KeyError((i, j, X))
+
+        if i == j:
+            return None
+
+        P, status, split, rule, finite = cell
+        r = int(rule[self.k, A])
+        return int(split[self.k, A]), self.cyk.nonterminals[self.cyk.left[r]], self.cyk.nonterminals[self.cyk.right[r]]
+
+    def __iter__(self):
+        n = len(self.words)
+        for i, l, A in zip(*np.nonzero(self.chart.P[self.k] != float("-inf"))):
+            yield (int(i), int(i + l - 1), self.cyk.nonterminals[A])
+        for i, A in zip(*np.nonzero(self.chart.P_wide[self.k] != float("-inf"))):
+            yield (int(i), n, self.cyk.nonterminals[A])
+        for i in range(1, n + 1):
+            yield (i, i, self.words[i - 1])
+
+    def __len__(self):
+        return (
+            int(np.count_nonzero(self.chart.P[self.k] != float("-inf")))
+            + int(np.count_nonzero(self.chart.P_wide[self.k] != float("-inf")))
+            + len(self.words)
+        )
+
+
+class Dense_CYK:
+    # max_span bounds the cells pairing rules may build: a cell wider than
+    # max_span can only be S -> L S (an unpaired extension of the whole
+    # suffix), so the parse costs O(n * W^2) instead of O(n^3).
+    # pair_mask[a, b] (alignment columns a and b, from 0) says whether the
+    # two columns may pair; cells over other pairs skip the pair-closing
+    # rules. mask_counts tallies the cells seen and skipped.
+    # kernel names the engine in the kernel counters.
+    kernel = "dense"
+
+    def __init__(self, pcfg: PCNF, max_span=None, pair_mask=None):
+        self.pcfg = pcfg
+        self.max_span = max_span
+        self.pair_mask = pair_mask
+        self.mask_counts = {"cells": 0, "skipped": 0}
+        self.compile()
+
+    # Integer ids and log-probabilities come from the grammar's compiled index
+    def compile(self):
+        compiled = self.pcfg.compiled
+
+        self.nonterminals = compiled.symbols
+        self.index = compiled.index
+        self.parent = compiled.parent
+        self.left = compiled.left
+        self.right = compiled.right
+        self.logq = compiled.logp
+        self.unary = compiled.unary
+
+        self.is_start = np.array([self.nonterminals[A].startswith("$") for A in self.parent], dtype=bool)
+        self.marks_status = np.array(
+            [self.nonterminals[B].startswith("$") or self.nonterminals[C].startswith("$")
+             for B, C in zip(self.left, self.right)],
+            dtype=bool,
+        )
+
+        # Rules grouped by parent (stable, so rule order inside a group is kept)
+        self.order = np.argsort(self.parent, kind="stable")
+
+        # Rules allowed in cells wider than max_span: S -> L S
+        self.wide_rules = np.array(
+            [r for r in self.order
+             if (self.nonterminals[self.parent[r]], self.nonterminals[self.left[r]], self.nonterminals[self.right[r]]) == ("S", "L", "S")],
+            dtype=np.intp,
+        )
+
+        # Rules that close a pair over their cell: X -> $M E
+        closes_pair = np.array(
+            [self.nonterminals[B].startswith("$M") and self.nonterminals[C].startswith("E")
+             for B, C in zip(self.left, self.right)],
+            dtype=bool,
+        )
+        self.unpaired_order = self.order[~closes_pair[self.order]]
+
+    # (nonterminal id, logp) pairs that can derive the word at position i
+    def leaf_scores(self, words, i):
+        return self.unary.get(words[i - 1], [])
+
+    # Log-probability of every binary rule when it builds cell (i, j)
+    def cell_logq(self, i, j):
+        return self.logq
+
+    # Called before the cells of span length l (at most max_span) are
+    # built, with the cells of every shorter span already final; finite is
+    # indexed by span, finite[i, span, A]
+    def prepare_span(self, words, l, finite):
+        pass
+
+    def span_limit(self, n):
+        return n if self.max_span is None else max(1, min(self.max_span, n))
+
+    # Whether words i and j (from 1) may be paired under pair_mask
+    def pair_allowed(self, i, j):
+        return self.pair_mask is None or bool(self.pair_mask[self.positions[i - 1], self.positions[j - 1]])
+
+    def mask_info(self):
+        cells = self.mask_counts["cells"]
+        return {**self.mask_counts, "skipped_fraction": self.mask_counts["skipped"] / cells if cells else 0.0}
+
+    def clear_mask_counts(self):
+        self.mask_counts = {"cells": 0, "skipped": 0}
+
+    # Fills the chart for a batch of K (start_ratio, accelerat_ratio) pairs
+    # at once; the ratios may be scalars (K = 1) or sequences. sign_count,
+    # if given, returns the K log flag bonuses of cell (i, j). positions
+    # are the alignment columns of the words (0, 1, ... by default).
+    def fill_chart(self, words, start_ratio, accelerat_ratio, sign_count=None, positions=None):
+        n = len(words)
+        N = len(self.nonterminals)
+        R = len(self.parent)
+        W = self.span_limit(n)
+
+        start_ratio = np.atleast_1d(start_ratio)
+        accelerat_ratio = np.atleast_1d(accelerat_ratio)
+        K = len(start_ratio)
+
+        chart = Band_Chart(K, n, W, N)
+        P, status, finite = chart.P, chart.status, chart.finite
+        self.positions = list(range(n)) if positions is None else positions
+
+        for i in range(1, n + 1):
+            for A, logp in self.leaf_scores(words, i):
+                P[:, i, 1, A] = logp
+            finite[i, 1] = P[0, i, 1] != float("-inf")
+
+        log_start = np.array([log(x) for x in start_ratio])[:, None, None]
+        log_accelerat = np.array([log(x) for x in accelerat_ratio])[:, None, None]
+
+        # Work counts cover every member of the batch; rules filtered out
+        # by the reachability test count as skipped for all their splits
+        counting = kernel_counters.enabled
+
+        for l in range(2, n + 1):
+            if l <= W:
+                self.prepare_span(words, l, finite)
+                rows = range(1, n + 2 - l)
+                rules = self.order
+                width = l - 1
+            else:
+                rows = [n + 1 - l]
+                rules = self.wide_rules
+                width = W
+            if not len(rules):
+                continue
+
+            evaluated = passed = start = accelerate = 0
+            for i in rows:
+                j = i + l - 1
+                ks = np.arange(i, i + width)
+                spans = j - ks
+
+                cell_rules = rules
+                if self.pair_mask is not None and l <= W:
+                    self.mask_counts["cells"] += 1
+                    if not self.pair_allowed(i, j):
+                        self.mask_counts["skipped"] += 1
+                        cell_rules = self.unpaired_order
+
+                # Only rules whose children can both be built somewhere in the cell
+                left_any = finite[i, 1:width + 1].any(0)
+                right_any = chart.cells(finite, chart.finite_wide, ks + 1, spans).any(0)
+                active = cell_rules[left_any[self.left[cell_rules]] & right_any[self.right[cell_rules]]]
+                if __debug__ and counting:
+                    evaluated += K * width * len(cell_rules)
+                if not len(active):
+                    continue
+
+                B = self.left[active]
+                C = self.right[active]
+                right_P = chart.cells(P, chart.P_wide, ks + 1, spans)
+                scores = P[:, i, 1:width + 1][:, :, B] + self.cell_logq(i, j)[active] + right_P[:, :, C]
+
+                if __debug__ and counting:
+                    reachable = (P[:, i, 1:width + 1][:, :, B] != float("-inf")) & (right_P[:, :, C] != float("-inf"))
+                    passed += int(np.count_nonzero(reachable))
+
+                starts = self.is_start[active]
+                if starts.any():
+                    right_status = chart.cells(status, chart.status_wide, ks + 1, spans)
+                    flagged = status[:, i, 1:width + 1][:, :, B] | right_status[:, :, C]
+                    if __debug__ and counting:
+                        accelerate += int(np.count_nonzero(reachable & flagged & starts))
+                        start += int(np.count_nonzero(reachable & ~flagged & starts))
+                    bonus = scores
+                    if sign_count is not None:
+                        bonus = bonus + np.atleast_1d(sign_count(i, j))[:, None, None]
+                    bonus = bonus + np.where(flagged, log_accelerat, log_start)
+                    scores = np.where(starts, bonus, scores)
+
+                best = scores.max(1)
+                best_k = scores.argmax(1)
+
+                parents = self.parent[active]
+                bounds = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+                group_best = np.maximum.reduceat(best, bounds, axis=1)
+                group_of = np.repeat(np.arange(len(bounds)), np.diff(np.r_[bounds, len(active)]))
+
+                # First (k, rule) reaching the maximum wins, as in the dict engine
+                key = np.where(best == group_best[:, group_of], best_k * R + active, np.iinfo(np.int64).max)
+                winner = np.minimum.reduceat(key, bounds, axis=1)
+
+                A = parents[bounds]
+                reached = group_best != float("-inf")
+                r = np.where(reached, winner % R, 0)
+                cell_P, cell_status, cell_split, cell_rule, cell_finite = chart.cell(i, j)
+                cell_P[:, A] = group_best
+                cell_split[:, A] = np.where(reached, i + winner // R, 0)
+                cell_rule[:, A] = r
+                cell_status[:, A] = reached & self.marks_status[r]
+                cell_finite[A] = reached.any(0)
+
+            if __debug__ and counting:
+                kernel_counters.add(self.kernel, l, cells=len(rows), evaluated=evaluated, skipped=evaluated - passed, start=start, accelerate=accelerate)
+
+        return chart
+
+    def sentence_prob(self, sentence: str, start_ratio: float, accelerat_ratio: float):
+        return self.sentence_prob_batch(sentence, [start_ratio], [accelerat_ratio])[0]
+
+    def sentence_prob__(self, sentence: str, start_ratio: float, accelerat_ratio: float, flag_ratio: float):
+        return self.sentence_prob_batch__(sentence, [start_ratio], [accelerat_ratio], [flag_ratio])[0]
+
+    # Largest batch whose chart stays within about max_floats scores
+    def batch_size(self, length, max_floats=2**23):
+        return max(1, max_floats // ((length + 2) * (self.span_limit(length) + 1) * len(self.nonterminals)))
+
+    # (prob, table) of sentence_prob for every (start_ratio, accelerat_ratio)
+    def sentence_prob_batch(self, sentence: str, start_ratios, accelerat_ratios):
+        words = sentence.strip().split(" ")
+        S = self.index["S"]
+
+        results = []
+        size = self.batch_size(len(words))
+        for b in range(0, len(start_ratios), size):
+            chart = self.fill_chart(words, start_ratios[b:b + size], accelerat_ratios[b:b + size])
+            for k in range(chart.K):
+                results.append((chart.score(k, 1, len(words), S), Dense_Table(self, words, chart, k)))
+        return results
+
+    # (prob, table) of sentence_prob__ for every (start_ratio,
+    # accelerat_ratio, flag_ratio)
+    def sentence_prob_batch__(self, sentence: str, start_ratios, accelerat_ratios, flag_ratios):
+        words = sentence.strip().split(" ")
+
+        filtered_sentence = []
+        filtered_indices = []
+        for i, w in enumerate(words):
+            if w not in ("<", ">"):
+                filtered_sentence.append(w)
+                filtered_indices.append(i)
+
+        if len(filtered_sentence) == 0:
+            return [(float(0), Packed_Table([], [], {})) for _ in start_ratios]
+
+        total_mismatch = self.pcfg.calculate_mismatch(words)
+        S = self.index["S"]
+        length = len(filtered_sentence)
+
+        results = []
+        size = self.batch_size(length)
+        for b in range(0, len(start_ratios), size):
+            flags = flag_ratios[b:b + size]
+
+            def sign_count(i, j):
+                count = total_mismatch.total(filtered_indices[i - 1], filtered_indices[j - 1])
+                return np.array([log(pow(flag_ratio, count)) for flag_ratio in flags])
+
+            chart = self.fill_chart(
+                filtered_sentence, start_ratios[b:b + size], accelerat_ratios[b:b + size], sign_count, filtered_indices
+            )
+            for k in range(chart.K):
+                results.append((chart.score(k, 1, length, S), Dense_Table(self, filtered_sentence, chart, k)))
+        return results
+
+
+class Lattice_CYK(Dense_CYK):
+    # Parses with the base structure grammar and reads the alignment column
+    # likelihoods per position and per position pair (the pair mapping may
+    # be lazy), instead of exploding the grammar into one nonterminal per
+    # column.
+    # Scores are built exactly as extend_grammar builds rule probabilities,
+    # so the Viterbi structure is the same as with the extended grammar.
+    kernel = "lattice"
+
+    def __init__(self, pcfg: PCNF, single_column_probs, paired_column_probs, max_span=None, pair_mask=None):
+        self.single_column_probs = single_column_probs
+        self.paired_column_probs = paired_column_probs
+        self.columns = {column_term(column): column for column in single_column_probs}
+        super().__init__(pcfg, max_span, pair_mask)
+
+    def compile(self):
+        super().compile()
+        q = self.pcfg.q
+
+        self.pair_rules = [
+            r for r, (A, B, C) in enumerate(self.pcfg.grammar.binary_rules)
+            if B == "$M" and C == "E"
+        ]
+        self.pair_q = [q[self.pcfg.grammar.binary_rules[r]] for r in self.pair_rules]
+
+        self.single_rules = [(self.index[A], q[(A, w)]) for A, w in self.pcfg.grammar.unary_rules if w == "s"]
+        self.paired_rules = [(self.index[A], log(q[(A, w)])) for A, w in self.pcfg.grammar.unary_rules if w == "d"]
+
+    def fill_chart(self, words, start_ratio, accelerat_ratio, sign_count=None, positions=None):
+        self.words_columns = [self.columns.get(w) for w in words]
+
+        # single[i]: log(q(X -> s) * P(column i)) for each unpaired rule
+        self.single = [
+            [(A, log(prob * self.single_column_probs[column])) for A, prob in self.single_rules]
+            if column is not None else []
+            for column in self.words_columns
+        ]
+
+        # Rule log-probabilities of cells that cannot use a pair rule
+        self.unpaired_logq = self.logq.copy()
+        self.unpaired_logq[self.pair_rules] = float("-inf")
+        self.pair_logq = {}
+
+        return super().fill_chart(words, start_ratio, accelerat_ratio, sign_count, positions)
+
+    # X -> $M E builds (i, j) only from $M over (i, j - 1) and E over j, so
+    # pairs are looked up (and, for a lazy mapping, computed in one batch)
+    # just for the cells of this span whose $M is reachable and whose
+    # columns the pair mask allows
+    def prepare_span(self, words, l, finite):
+        M = self.index.get("$M")
+        if M is None or not self.pair_rules:
+            return
+
+        columns = self.words_columns
+        pairs = {}
+        for i in range(1, len(words) + 2 - l):
+            j = i + l - 1
+            if finite[i, l - 1, M] and columns[i - 1] is not None and columns[j - 1] is not None and self.pair_allowed(i, j):
+                pairs[(i, j)] = tuple(a + b for a, b in zip(columns[i - 1], columns[j - 1]))
+
+        prefetch = getattr(self.paired_column_probs, "prefetch", None)
+        if prefetch is not None:
+            prefetch(pairs.values())
+
+        # pair_logq[i, j]: rule log-probabilities with the pair likelihood
+        # of columns i and j folded into the X -> $M E rules
+        for cell, pair in pairs.items():
+            if pair not in self.paired_column_probs:
+                continue
+            logq = self.logq.copy()
+            for r, prob in zip(self.pair_rules, self.pair_q):
+                logq[r] = log(prob * self.paired_column_probs[pair])
+            self.pair_logq[cell] = logq
+
+    def leaf_scores(self, words, i):
+        if self.columns.get(words[i - 1]) is None:
+            return []
+        return self.single[i - 1] + self.paired_rules
+
+    def cell_logq(self, i, j):
+        return self.pair_logq.get((i, j), self.unpaired_logq)
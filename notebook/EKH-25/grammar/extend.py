@@ -0,0 +1,72 @@
+from collections import defaultdict
+from grammar.pcnf import PCNF
+
+
+def column_term(column):
+    return str(column).replace(" ", "")
+
+
+# Specializes the base structure grammar to the columns of one alignment:
+# pairing rules get one $M/B/E nonterminal per column and emissions carry
+# the column likelihoods. The grammar is built in memory; pass filename to
+# also export it as {filename}.cfg and {filename}.pcfg.
+def extend_grammar(
+    columns,
+    pcfg: PCNF,
+    single_column_probs,
+    paired_column_probs,
+    filename=None
+):
+    cfg = []
+    q = defaultdict(float)
+
+    def add_binary(A, B, C, prob):
+        cfg.append((A, f"{B} {C}"))
+        q[(A, B, C)] = float(prob)
+
+    def add_unary(A, w, prob):
+        cfg.append((A, w))
+        q[(A, w)] = float(prob)
+
+    for A, B, C in pcfg.grammar.binary_rules:
+        if A == "$M" and B == "B" and C == "F":
+            for column, prob in single_column_probs.items():
+                if columns.get(column, False):
+                    term = column_term(column)
+                    add_binary(A + term, f"B{term.lower()}", "F", pcfg.q[(A, B, C)])
+        elif B == "$M" and C == "E":
+            for column, prob in paired_column_probs.items():
+                left_column = tuple(pair[0] for pair in column if pair)
+                right_column = tuple(pair[1] for pair in column if pair)
+                if columns.get(left_column, False) and columns.get(right_column, False):
+                    left_term = column_term(left_column)
+                    right_term = column_term(right_column)
+                    add_binary(A, f"$M{left_term}", f"E{right_term.lower()}", pcfg.q[(A, B, C)] * prob)
+        else:
+            add_binary(A, B, C, pcfg.q[(A, B, C)])
+
+    for A, w in pcfg.grammar.unary_rules:
+        if w == "s":
+            for column, prob in single_column_probs.items():
+                if columns.get(column, False):
+                    add_unary(A, column_term(column), pcfg.q[(A, w)] * prob)
+        elif w == "d":
+            for column, prob in single_column_probs.items():
+                if columns.get(column, False):
+                    term = column_term(column)
+                    add_unary(A + term.lower(), term, pcfg.q[(A, w)])
+        else:
+            add_unary(A, w, pcfg.q[(A, w)])
+
+    extended = PCNF.from_rules(cfg, q)
+    if filename:
+        save_grammar(extended, filename)
+    return extended
+
+
+def save_grammar(pcfg: PCNF, filename):
+    with (open(f"{filename}.pcfg", "w+") as pcfg_file, open(f"{filename}.cfg", "w+") as cfg_file):
+        for lhs, rhs in pcfg.grammar.cfg:
+            rule = (lhs, *rhs.split())
+            pcfg_file.write(f"{lhs} -> {rhs} {pcfg.q[rule]}" + "\n")
+            cfg_file.write(f"{lhs} -> {rhs}" + "\n")
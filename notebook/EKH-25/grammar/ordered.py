@@ -1,6 +1,8 @@
 import networkx as nx
 import matplotlib.pyplot as plt
 import json  # Added for reading and writing JSON files
+import heapq
+from collections import defaultdict
 
 class Ordered:
     def __init__(self, define_rules=None, probabilities=None, filename=None):
@@ -29,97 +31,247 @@ class Ordered:
             data = json.load(file)
         return data["define_rules"], data["probabilities"]
 
-    # Predictor operation: adds new rules to the chart based on grammar rules
-    def predictor(self, rule, state):
-        current_symbol = rule["rhs"][rule["dot"]]
-        # Check if the symbol is a non-terminal
-        if current_symbol.isupper():
-            return [{
-                "lhs": current_symbol,
-                "rhs": rhs,
-                "dot": 0,
-                "state": state,
-                "end": state,
-                "op": "PREDICTOR",
-                "completor": [],
-                "probability": self.probabilities[current_symbol][i][0]
-            } for i, rhs in enumerate(self.define_rules[current_symbol])]
-        return []
-
-    # Scanner operation: matches terminal symbols in the input
-    def scanner(self, rule, next_input):
-        current_symbol = rule["rhs"][rule["dot"]]
-        # Check if the current symbol is a terminal and matches the next input
-        if current_symbol.islower() and next_input in self.define_rules[current_symbol]:
-            return [{
-                "lhs": current_symbol,
-                "rhs": [next_input],
-                "dot": 1,
-                "state": rule["end"],
-                "end": rule["end"] + 1,
-                "op": "SCANNER",
+    # Rules as (lhs, rhs, probability) records with integer ids; rule 0 is
+    # ROOT -> S. A terminal category c that produces the word w is the rule
+    # c -> w, so a scanned word is completed like any other item. Only
+    # rules whose symbols all derive some words are indexed in rules_of:
+    # the others are never predicted, so every item in the chart can still
+    # be completed.
+    def compile(self):
+        self.rules = [("ROOT", ("S",), 1.0)]
+        self.rules_of = defaultdict(list)
+        self.word_rules = {}
+        for symbol, productions in self.define_rules.items():
+            if symbol.isupper():
+                for i, rhs in enumerate(productions):
+                    self.rules.append((symbol, tuple(rhs), self.probabilities[symbol][i][0]))
+            elif symbol.islower():
+                for word in productions:
+                    self.word_rules[(symbol, word)] = len(self.rules)
+                    self.rules.append((symbol, (word,), self.probabilities[symbol][word]))
+
+        generating = {symbol for symbol, productions in self.define_rules.items() if symbol.islower() and productions}
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, _ in self.rules:
+                if lhs.isupper() and lhs not in generating and all(symbol in generating for symbol in rhs):
+                    generating.add(lhs)
+                    changed = True
+
+        for r, (lhs, rhs, _) in enumerate(self.rules):
+            if r and lhs.isupper() and all(symbol in generating for symbol in rhs):
+                self.rules_of[lhs].append(r)
+        self.generating = generating
+
+    # Chart position e holds items (rule, dot, origin) -> [probability,
+    # child, forward], where child is the completed item (in the same chart)
+    # that moved the dot last and forward is the best probability of
+    # reaching the item from ROOT; waiting[e][X] lists the items whose next
+    # symbol is X. Each item keeps only its best (Viterbi) probabilities.
+    def add_item(self, e, key, probability, child, forward=0.0):
+        items = self.charts[e]
+        known = items.get(key)
+        if known is not None:
+            if forward > known[2]:
+                known[2] = forward
+            if known[0] >= probability:
+                return
+            known[0], known[1] = probability, child
+        else:
+            items[key] = [probability, child, forward]
+
+        rule, dot, origin = key
+        rhs = self.rules[rule][1]
+        if dot == len(rhs):
+            # Completed items are processed longest-origin-last, so their
+            # probability is final before it is used; an improved item is
+            # simply queued again
+            self.sequence += 1
+            heapq.heappush(self.completed, (-origin, self.sequence, key))
+        elif known is None:
+            self.waiting[e][rhs[dot]].append(key)
+            self.predicting.append(key)
+
+    # Predicts and completes everything at position e, then sets the
+    # forward probability of its predicted items
+    def close(self, e):
+        items = self.charts[e]
+        predicted = set()
+        while self.predicting or self.completed:
+            while self.predicting:
+                rule, dot, origin = self.predicting.pop()
+                symbol = self.rules[rule][1][dot]
+                if symbol.isupper() and symbol not in predicted:
+                    predicted.add(symbol)
+                    for r in self.rules_of[symbol]:
+                        self.add_item(e, (r, 0, e), self.rules[r][2], None)
+
+            # The completion loop is the cubic part of the parse; an advanced
+            # item that is already known and not improved is settled inline
+            # without a call to add_item
+            if self.completed:
+                _, _, key = heapq.heappop(self.completed)
+                probability = items[key][0]
+                lhs = self.rules[key[0]][0]
+                origin = key[2]
+                waiting = self.waiting[origin].get(lhs, ())
+                if origin == e:
+                    waiting = list(waiting)
+                waiting_items = self.charts[origin]
+                for rule, dot, start in waiting:
+                    parent = waiting_items[(rule, dot, start)]
+                    advanced = (rule, dot + 1, start)
+                    value, forward = parent[0] * probability, parent[2] * probability
+                    known = items.get(advanced)
+                    if known is not None and known[0] >= value:
+                        if forward > known[2]:
+                            known[2] = forward
+                        continue
+                    self.add_item(e, advanced, value, key, forward)
+
+        self.forward(e)
+
+    # A rule predicted at e is reached through the items waiting on its lhs,
+    # possibly along a chain of predicted left corners; the chain is relaxed
+    # best-first, so each symbol's forward probability is final when popped
+    def forward(self, e):
+        items = self.charts[e]
+        reach = {}
+        for symbol, keys in self.waiting[e].items():
+            seeds = [items[key][2] for key in keys if key[1] or key[0] == 0]
+            if symbol.isupper() and seeds:
+                reach[symbol] = max(seeds)
+
+        heap = [(-value, symbol) for symbol, value in reach.items()]
+        heapq.heapify(heap)
+        while heap:
+            value, symbol = heapq.heappop(heap)
+            if -value < reach[symbol]:
+                continue
+            for r in self.rules_of[symbol]:
+                forward = reach[symbol] * self.rules[r][2]
+                items[(r, 0, e)][2] = forward
+                rhs = self.rules[r][1]
+                if rhs and rhs[0].isupper() and forward > reach.get(rhs[0], 0.0):
+                    reach[rhs[0]] = forward
+                    heapq.heappush(heap, (-forward, rhs[0]))
+
+    # Scans word at position e into position e + 1
+    def scan(self, e, word):
+        self.charts.append({})
+        self.waiting.append(defaultdict(list))
+        prefix = 0.0
+        for symbol, keys in self.waiting[e].items():
+            r = self.word_rules.get((symbol, word)) if symbol.islower() else None
+            if r is not None:
+                forward = max(self.charts[e][key][2] for key in keys) * self.rules[r][2]
+                self.add_item(e + 1, (r, 1, e), self.rules[r][2], None, forward)
+                prefix = max(prefix, forward)
+        self.prefixes.append(prefix)
+
+    # Incremental parsing: start() opens an empty prefix and feed() extends
+    # it by one word, keeping the chart built so far, so each word only
+    # costs the chart work of its own position
+    def start(self):
+        self.compile()
+        self.charts = [{}]
+        self.waiting = [defaultdict(list)]
+        self.predicting = []
+        self.completed = []
+        self.sequence = 0
+        self.prefixes = [1.0]
+
+        if "S" in self.generating:
+            self.add_item(0, (0, 0, 0), 1.0, None, 1.0)
+        self.close(0)
+
+    def feed(self, word):
+        e = len(self.charts) - 1
+        self.scan(e, word)
+        self.close(e + 1)
+        return self.prefix_probability()
+
+    # Best forward probability of the words fed so far: the probability of
+    # the best partial leftmost derivation from ROOT that has produced them,
+    # without the cost of completing its pending symbols. It is an upper
+    # bound on the probability of any sentence starting with the prefix. It
+    # never rises as words are fed, since scanning, completion and
+    # prediction only multiply in probabilities <= 1, and it is exactly 0.0
+    # once the prefix is rejected, so a caller can stop at a threshold.
+    def prefix_probability(self):
+        return self.prefixes[-1]
+
+    # Whether some sentence of the grammar can still start with the words
+    # fed so far; compile() leaves out rules that derive no words, so any
+    # live item can be completed
+    def is_viable(self):
+        return bool(self.charts[-1])
+
+    # Best probability of the words fed so far as a whole sentence
+    def sentence_probability(self):
+        root = self.charts[-1].get((0, 1, 0))
+        return root[0] if root is not None else 0.0
+
+    # Implements the Earley parsing algorithm. Returns self.charts, one dict
+    # of items per position 0..n (see add_item); chart_records() gives the
+    # n + 2 lists of item records the list-based chart used to return. With
+    # one item per (rule, dot, origin) the chart holds O(n^2 |G|) items and
+    # completion costs O(n^3 |G|) time, the Earley bound for ambiguous
+    # grammars, which the structure grammar reaches
+    def early_parser(self, sentence: str):
+        self.start()
+        for word in sentence.split():
+            self.feed(word)
+        return self.charts
+
+    # Old-style item record of key at position e, with its children's
+    # records in "completor" (last child first)
+    def item_record(self, e, key):
+        def record(e, key):
+            rule, dot, origin = key
+            lhs, rhs, _ = self.rules[rule]
+            return {
+                "lhs": lhs,
+                "rhs": list(rhs),
+                "dot": dot,
+                "state": origin,
+                "end": e,
+                "op": (
+                    "DUMMY" if rule == 0 and dot == 0
+                    else "PREDICTOR" if dot == 0
+                    else "SCANNER" if len(rhs) == 1 and (lhs, rhs[0]) in self.word_rules
+                    else "COMPLETOR"
+                ),
                 "completor": [],
-                "probability": self.probabilities[current_symbol][next_input]
-            }]
-        return []
-
-    # Completor operation: updates existing rules in the chart
-    def completor(self, rule):
-        return [
-            {
-                "lhs": r["lhs"],
-                "rhs": r["rhs"],
-                "dot": r["dot"] + 1,
-                "state": r["state"],
-                "end": rule["end"],
-                "op": "COMPLETOR",
-                "completor": [rule] + r["completor"],
-                "probability": rule["probability"] * r["probability"]
+                "probability": self.charts[e][key][0],
             }
-            for r in self.charts[rule["state"]]
-            if r["dot"] < len(r["rhs"]) and r["rhs"][r["dot"]] == rule["lhs"]
-        ]
 
-    # Implements the Earley parsing algorithm
-    def early_parser(self, sentence: str):
-        input_arr = sentence.split() + [""]
-        # Initialize the chart with the initial state
-        self.charts = [[{
-            "lhs": "ROOT",
-            "rhs": ["S"],
-            "dot": 0,
-            "state": 0,
-            "end": 0,
-            "op": "DUMMY",
-            "completor": [],
-            "probability": 1.0
-        }]]
-
-        # Iterate through each position in the input sentence
-        for curr_state in range(len(input_arr)):
-            curr_chart = self.charts[curr_state]
-            next_chart = []
-
-            for curr_rule in curr_chart:
-                if curr_rule["dot"] < len(curr_rule["rhs"]):
-                    # Perform prediction
-                    for pred_rule in self.predictor(curr_rule, curr_state):
-                        if pred_rule not in curr_chart:
-                            curr_chart.append(pred_rule)
-
-                    # Perform scanning
-                    for scan_rule in self.scanner(curr_rule, input_arr[curr_state]):
-                        if scan_rule not in next_chart:
-                            next_chart.append(scan_rule)
-                else:
-                    # Perform completion
-                    for comp_rule in self.completor(curr_rule):
-                        if comp_rule not in curr_chart:
-                            curr_chart.append(comp_rule)
-
-            self.charts.append(next_chart)
+        root = record(e, key)
+        stack = [(root, e, key)]
+        while stack:
+            node, end, (rule, dot, origin) = stack.pop()
+            child = self.charts[end][(rule, dot, origin)][1]
+            while child is not None:
+                child_record = record(end, child)
+                node["completor"].append(child_record)
+                stack.append((child_record, end, child))
+                dot, end = dot - 1, child[2]
+                child = self.charts[end][(rule, dot, origin)][1]
+        return root
 
-        return self.charts
+    # The charts as lists of item records, the last one empty for the end of
+    # input, as the list-based chart returned them; for inspecting short
+    # sentences, since every record carries its best derivation
+    def chart_records(self):
+        return [[self.item_record(e, key) for key in chart] for e, chart in enumerate(self.charts)] + [[]]
+
+    # Most probable parse of the last parsed sentence, or None
+    def best_parse(self):
+        key = (0, 1, 0)
+        if key not in self.charts[-1]:
+            return None
+        return self.item_record(len(self.charts) - 1, key)
 
     # Recursively adds nodes and edges to the graph for visualization
     def add_nodes_and_edges(self, graph, node, parent=None, depth=0):
@@ -134,9 +286,9 @@ class Ordered:
 
     # Build and visualize the parse tree
     def build_tree(self):
-        roots = [r for r in self.charts[-2] if r["lhs"] == "ROOT" and r["dot"] == len(r["rhs"])]
-        roots = sorted(roots, key=lambda root: root["probability"], reverse=True)
-        root = roots[0]
+        root = self.best_parse()
+        if root is None:
+            raise ValueError("The sentence has no parse")
         
         print(f"Prob: {root['probability']}")  # Display the probability of the chosen parse
         graph = nx.DiGraph()  # Create a directed graph
@@ -1,21 +1,49 @@
 import random
 from grammar.cnf import CNF
 from collections import defaultdict
-from grammar.expected_count import Expected_Count
-
-def log(x): 
-    from math import log
-    if x > 0: return log(x)
-    else: return float("-inf")
+from multiprocessing import Pool
+from contextlib import nullcontext
+from grammar.expected_count import init_count_worker, count_shard, count_sentences
+from grammar.compiled import Compiled_Grammar, load_cache, save_cache, log
+from grammar.traceback import LEAF, Packed_Table
+from grammar.brackets import Bracket_Ranges
+from grammar.sampler import Grammar_Sampler
+from profiling.counters import kernel_counters
 
 class PCNF:
-    def __init__(self, grammar_file: str, probablity_file=""):
-        self.grammar = CNF(grammar_file)
+    def __init__(self, grammar_file: str, probablity_file="", cache=False):
+        # With cache=True an unchanged grammar is loaded from the binary
+        # cache next to the text files instead of being parsed again
+        cached = load_cache(grammar_file, probablity_file) if cache else None
+
+        self.grammar = cached["grammar"] if cached else CNF(grammar_file)
         if probablity_file == "":
             self.q = self.init_q()
+        elif cached:
+            self.q = defaultdict(float, cached["q"])
         else:
             self.q = self.read_pcfg_file(probablity_file)
 
+        if cached and probablity_file:
+            self.compiled = cached["compiled"]
+        else:
+            self.compiled = Compiled_Grammar(self.grammar, self.q)
+
+        if cache and not cached:
+            save_cache(grammar_file, probablity_file, self.grammar, self.q, self.compiled)
+
+        self.rule_sampler = None
+
+    # Builds a PCNF from in-memory (lhs, rhs) rules and their probabilities
+    @classmethod
+    def from_rules(cls, cfg, q):
+        pcfg = cls.__new__(cls)
+        pcfg.grammar = CNF("", cfg)
+        pcfg.q = q
+        pcfg.compiled = Compiled_Grammar(pcfg.grammar, pcfg.q)
+        pcfg.rule_sampler = None
+        return pcfg
+
     def read_pcfg_file(self, filename: str):
         pcfg = []
         with open(filename) as file:
@@ -39,6 +67,19 @@ class PCNF:
                     sentences.append(line.strip())
         return sentences
 
+    # Streams the corpus and collapses identical lines into
+    # (sentence, multiplicity) pairs, in order of first appearance. Unlike
+    # read_train_file, blank lines are dropped: as empty sentences they
+    # have no parse and add nothing to the counts
+    def read_train_corpus(self, filename: str):
+        corpus = {}
+        with open(filename) as f:
+            for line in f:
+                sentence = line.strip()
+                if sentence:
+                    corpus[sentence] = corpus.get(sentence, 0) + 1
+        return list(corpus.items())
+
     def init_q(self):
         q = defaultdict(float)
 
@@ -74,151 +115,86 @@ class PCNF:
                     sum = sum + q[(A, B, C)]
         return q
 
-    def estimate(self, train_file: str, iter_num=20):
+    # workers > 1 computes the expected counts in that many processes. That
+    # only pays off with as many free cores and a corpus whose iterations
+    # take seconds (tens of sentences of 100+ words); otherwise starting
+    # the pool and shipping q every iteration cost more than they save,
+    # which is why estimation is serial by default
+    def estimate(self, train_file: str, iter_num=20, workers=1):
         q = self.q
-        self.sentences = self.read_train_file(train_file)
+        self.corpus = self.read_train_corpus(train_file)
+        self.sentences = [sentence for sentence, _ in self.corpus]
 
-        for itration in range(1, iter_num + 1):
-            print("Itration number:", itration)
+        # The pool (None when serial) is terminated when the iterations end
+        # or fail, so no worker outlives estimate()
+        with (Pool(workers, initializer=init_count_worker, initargs=(self.grammar, self.sentences)) if workers > 1 else nullcontext()) as pool:
+            for itration in range(1, iter_num + 1):
+                print("Itration number:", itration)
 
-            f = defaultdict(float)
-
-            for A, w in self.grammar.unary_rules:
-                f[(A, w)] = 0.0
-
-            for A, B, C in self.grammar.binary_rules:
-                f[(A, B, C)] = 0.0
-
-            for i in range(0, len(self.sentences)):
-                sentence = self.sentences[i]
-                ec_instance = Expected_Count(sentence, self.grammar, q)
-                count = ec_instance.get_count()
+                f = defaultdict(float)
 
                 for A, w in self.grammar.unary_rules:
-                    f[(A, w)] += count.get((A, w))
+                    f[(A, w)] = 0.0
+
                 for A, B, C in self.grammar.binary_rules:
-                    f[(A, B, C)] += count.get((A, B, C))
-
-            for A in self.grammar.nonterminals:
-                sum_f = 0.0
-                for A2, w in self.grammar.unary_rules:
-                    if A2 == A:
-                        sum_f += f[(A, w)]
-
-                for A2, B, C in self.grammar.binary_rules:
-                    if A2 == A:
-                        sum_f += f[(A, B, C)]
-
-                for A2, w in self.grammar.unary_rules:
-                    if A2 == A and sum_f:
-                        q[(A, w)] = f[(A, w)] / sum_f
-                    if A2 == A and f[(A, w)] == 0.0:
-                        q[(A, w)] = 0.0
-
-                for A2, B, C in self.grammar.binary_rules:
-                    if A2 == A and sum_f:
-                        q[(A, B, C)] = f[(A, B, C)] / sum_f
-                    if A2 == A and f[(A, B, C)] == 0.0:
-                        q[(A, B, C)] = 0.0
+                    f[(A, B, C)] = 0.0
+
+                # Count vectors come back once per unique sentence in corpus order,
+                # so the sums below are the same for any number of workers
+                vectors = self.count_vectors(q, pool, workers)
+                skipped = sum(vector is None for vector in vectors)
+                if skipped:
+                    print("Skipped sentences without a parse:", skipped)
+                for (_, multiplicity), vector in zip(self.corpus, vectors):
+                    if vector is None:
+                        continue
+                    for (A, w), count in zip(self.grammar.unary_rules, vector):
+                        f[(A, w)] += multiplicity * count
+                    for (A, B, C), count in zip(self.grammar.binary_rules, vector[len(self.grammar.unary_rules):]):
+                        f[(A, B, C)] += multiplicity * count
+
+                for A in self.grammar.nonterminals:
+                    a = self.compiled.index[A]
+                    rules = [self.grammar.unary_rules[r] for r in self.compiled.unary_by_lhs[a]]
+                    rules += [self.grammar.binary_rules[r] for r in self.compiled.binary_by_lhs[a]]
+
+                    sum_f = 0.0
+                    for rule in rules:
+                        sum_f += f[rule]
+
+                    for rule in rules:
+                        if sum_f:
+                            q[rule] = f[rule] / sum_f
+                        if f[rule] == 0.0:
+                            q[rule] = 0.0
+
+        self.compiled = Compiled_Grammar(self.grammar, q)
+        self.rule_sampler = None
 
         print("Estimation complete!")
 
         return q
 
-    def sentence_prob(self, sentence: str, start_ratio: float, accelerat_ratio: float):
-        P = defaultdict(lambda: float("-inf"))
-        table = defaultdict(None)
-        status = defaultdict(bool)
-        
-        sentence = sentence.strip().split(" ")
-        length = len(sentence)
-
-        for i in range(1, length + 1):
-            for A, w in self.grammar.unary_rules:
-                if w == sentence[i - 1]:
-                    P[(i, i, A)] = log(self.q.get((A, w), 0))
-                    table[(i, i, A)] = [(i, i, w)]
-                    table[(i, i, w)] = []
+    # Shards are cut four per worker so that one shard of long sentences
+    # does not keep the other workers idle; starmap returns them in order
+    def count_vectors(self, q, pool, workers):
+        rules = self.grammar.unary_rules + self.grammar.binary_rules
+        probs = [q.get(rule, 0.0) for rule in rules]
+        if pool is None:
+            return count_sentences(self.grammar, rules, self.sentences, probs)
 
+        size = -(-len(self.sentences) // (4 * workers))
+        shards = [(probs, start, min(start + size, len(self.sentences))) for start in range(0, len(self.sentences), size)]
+        return [vector for vectors in pool.starmap(count_shard, shards, chunksize=1) for vector in vectors]
 
-        for l in range(2, length + 1):
-            for i in range(1, length + 2 - l):
-                j = i + l - 1
-                for k in range(i, j):
-                    for A, B, C in self.grammar.binary_rules:
-                        if (P.get((i, k, B), float("-inf")) != float("-inf")  
-                        and P.get((k + 1, j, C), float("-inf")) != float("-inf")):
-                            if A.startswith("$"):
-                                if (status.get((i, k, B), False) or status.get((k + 1, j, C), False)):
-                                    Prob = (P.get((i, k, B), float("-inf"))
-                                        + log(self.q.get((A, B, C), 0))
-                                        + P.get((k + 1, j, C), float("-inf")) 
-                                        + log(accelerat_ratio))       
-                                else:
-                                    Prob = (P.get((i, k, B), float("-inf"))
-                                       + log(self.q.get((A, B, C), 0))
-                                       + P.get((k + 1, j, C), float("-inf")) 
-                                       + log(start_ratio))  
-                                                    
-                            else:   
-                                Prob = (P.get((i, k, B), float("-inf"))
-                                   + log(self.q.get((A, B, C), 0))
-                                   + P.get((k + 1, j, C), float("-inf")))                          
-                                        
-                            if Prob > P.get((i, j, A), float("-inf")):
-                                P[(i, j, A)] = Prob
-                                table[(i, j, A)] = [(i, k, B), (k + 1, j, C)]
-                                if B.startswith("$") or C.startswith("$"):
-                                    status[(i, j, A)] = True
-                                else:
-                                    status[(i, j, A)] = False 
-                            
-                                
-        return P[1, length, "S"], table
+    def sentence_prob(self, sentence: str, start_ratio: float, accelerat_ratio: float):
+        words = sentence.strip().split(" ")
+        return self.viterbi(words, start_ratio, accelerat_ratio, kernel="sentence_prob")
     
     
+    # Unmatched bracket counts of any range of words, answered in O(1)
     def calculate_mismatch(self, words):
-        n = len(words)
-
-        # Initialize 2D arrays for mismatch, netopen, and total mismatch
-        mismatch = [[0] * n for _ in range(n)]
-        netopen = [[0] * n for _ in range(n)]
-        total_mismatch = [[0] * n for _ in range(n)]
-
-        # Base case: substrings of length 1
-        for i in range(n):
-            if words[i] == "<":
-                mismatch[i][i] = 0
-                netopen[i][i] = 1  # One unmatched '<'
-            elif words[i] == ">":
-                mismatch[i][i] = 1  # One unmatched '>'
-                netopen[i][i] = 0
-            else:
-                mismatch[i][i] = 0
-                netopen[i][i] = 0
-            total_mismatch[i][i] = mismatch[i][i] + netopen[i][i]
-
-        # Substrings of length >= 2
-        for length in range(2, n + 1):
-            for i in range(n - length + 1):
-                j = i + length - 1
-
-                # Start by copying the values from the substring words[i:j]
-                mismatch[i][j] = mismatch[i][j - 1]
-                netopen[i][j] = netopen[i][j - 1]
-
-                # Incorporate the bracket at position j
-                if words[j] == "<":
-                    netopen[i][j] += 1  # Push one '<'
-                elif words[j] == ">":
-                    if netopen[i][j] > 0:
-                        netopen[i][j] -= 1  # Match with a previous '<'
-                    else:
-                        mismatch[i][j] += 1  # Unmatched '>'
-
-                total_mismatch[i][j] = mismatch[i][j] + netopen[i][j]
-
-        return total_mismatch
+        return Bracket_Ranges(words)
     
     def sentence_prob__(self, sentence: str, start_ratio: float, accelerat_ratio: float, flag_ratio: float):
         # Split sentence into words and identify ignored ones
@@ -236,81 +212,116 @@ class PCNF:
         length = len(filtered_sentence)
                 
         if length == 0:
-            return float(0), {}
-        
-        P = defaultdict(lambda: float("-inf"))
-        status = defaultdict(bool)  
-        table = defaultdict(None)
-                    
+            return float(0), Packed_Table(self.grammar.binary_rules, [], {})
+
+        # $-rules over words i..j are scaled by flag_ratio per unmatched bracket
+        def flag(i, j):
+            sign_count = total_mismatch.total(filtered_indices[i - 1], filtered_indices[j - 1])
+            return log(pow(flag_ratio, sign_count))
+
+        return self.viterbi(filtered_sentence, start_ratio, accelerat_ratio, flag, kernel="sentence_prob__")
+
+    # Viterbi CYK of the dict engine over the compiled index. A split only
+    # visits the rules whose left child is in the left cell (by_left) and
+    # keeps those whose right child is in the right cell, so unreachable
+    # (i, k, j, rule) combinations are never touched. $-rules are scaled by
+    # accelerat_ratio when a child was built from a $-rule and by
+    # start_ratio otherwise, and by flag(i, j) first when it is given. Of
+    # equal scores the first in (k, rule) order wins, as in a scan of the
+    # rules in grammar order.
+    def viterbi(self, words, start_ratio, accelerat_ratio, flag=None, kernel="sentence_prob"):
+        compiled = self.compiled
+        rules = self.grammar.binary_rules
+        R = len(rules)
+        dollar = [A.startswith("$") for A, B, C in rules]
+        from_dollar = [B.startswith("$") or C.startswith("$") for A, B, C in rules]
+        parent, right, logp = compiled.parent.tolist(), compiled.right.tolist(), compiled.logp.tolist()
+        by_left = {
+            b: [(r, parent[r], right[r], logp[r], dollar[r], from_dollar[r]) for r in indices]
+            for b, indices in compiled.by_left.items()
+        }
+        log_start, log_accelerat = log(start_ratio), log(accelerat_ratio)
+        symbols = compiled.symbols
+        counting = kernel_counters.enabled
+
+        # (i, j) -> {A: best log probability} and {A: built from a $-rule}
+        # for the cells' reachable nonterminals, by symbol id
+        length = len(words)
+        P = {}
+        status = {}
+        table = {}
         for i in range(1, length + 1):
-            for A, w in self.grammar.unary_rules:
-                if w == filtered_sentence[i - 1]:
-                    P[(i, i, A)] = log(self.q.get((A, w), 0))
-                    table[(i, i, A)] = [(i, i, w)]
-                    table[(i, i, w)] = []
-
-        # Binary rules (off-diagonal cells)
-        for l in range(2, length + 1):  
-            for i in range(1, length + 2 - l):  
-                j = i + l - 1  # End index                
+            cell = P[(i, i)] = {}
+            status[(i, i)] = {}
+            for a, logq in compiled.unary.get(words[i - 1], ()):
+                if logq != float("-inf"):
+                    cell[a] = logq
+                table[(i, i, symbols[a])] = LEAF
+
+        for l in range(2, length + 1):
+            passed = start = accelerate = 0
+            for i in range(1, length + 2 - l):
+                j = i + l - 1
+                cell = {}
+                cell_status = {}
+                back = {}
+                ratio = flag(i, j) if flag else None
                 for k in range(i, j):
-                    for A, B, C in self.grammar.binary_rules:
-                        if (P.get((i, k, B), float("-inf")) != float("-inf")  
-                        and P.get((k + 1, j, C), float("-inf")) != float("-inf")):
-                            if A.startswith("$"):
-                                start_idx = filtered_indices[i-1]
-                                end_idx   = filtered_indices[j-1]
-
-                                sign_count = total_mismatch[start_idx][end_idx]
-                                                                
-                                if status.get((i, k, B), False) or status.get((k + 1, j, C), False):
-                                    Prob = (P.get((i, k, B), float("-inf"))
-                                           + log(self.q.get((A, B, C), 0))
-                                           + P.get((k + 1, j, C), float("-inf")) 
-                                           + log(pow(flag_ratio, sign_count)) 
-                                           + log(accelerat_ratio))
-                                else:                                                                
-                                    Prob = (P.get((i, k, B), float("-inf"))
-                                           + log(self.q.get((A, B, C), 0))
-                                           + P.get((k + 1, j, C), float("-inf")) 
-                                           + log(pow(flag_ratio, sign_count))
-                                           + log(start_ratio))
-                                    
-                            else:
-                                Prob = (P.get((i, k, B), float("-inf"))
-                                    + log(self.q.get((A, B, C), 0))
-                                    + P.get((k + 1, j, C), float("-inf")))
-                                     
-                            if Prob > P.get((i, j, A), float("-inf")):
-                                P[(i, j, A)] = Prob
-                                table[(i, j, A)] = [(i, k, B), (k + 1, j, C)]
-                                if B.startswith("$") or C.startswith("$"):
-                                    status[(i, j, A)] = True
+                    right = P[(k + 1, j)]
+                    if not right:
+                        continue
+                    left_status = status[(i, k)]
+                    right_status = status[(k + 1, j)]
+                    split = k * R
+                    for b, left_prob in P[(i, k)].items():
+                        for r, a, c, logq, is_dollar, is_from_dollar in by_left.get(b, ()):
+                            right_prob = right.get(c)
+                            if right_prob is None:
+                                continue
+                            if __debug__ and counting:
+                                passed += 1
+                            Prob = left_prob + logq + right_prob
+                            if is_dollar:
+                                if ratio is not None:
+                                    Prob += ratio
+                                if left_status.get(b, False) or right_status.get(c, False):
+                                    if __debug__ and counting:
+                                        accelerate += 1
+                                    Prob += log_accelerat
                                 else:
-                                    status[(i, j, A)] = False 
-                                    
-        return P[1, length, "S"], table
+                                    if __debug__ and counting:
+                                        start += 1
+                                    Prob += log_start
+
+                            best = cell.get(a, float("-inf"))
+                            if Prob > best or (Prob == best != float("-inf") and split + r < back[a]):
+                                cell[a] = Prob
+                                back[a] = split + r
+                                cell_status[a] = is_from_dollar
+
+                P[(i, j)] = cell
+                status[(i, j)] = cell_status
+                for a, packed in back.items():
+                    table[(i, j, symbols[a])] = packed
+
+            if __debug__ and counting:
+                cells = length + 1 - l
+                kernel_counters.add(kernel, l, cells=cells, evaluated=cells * (l - 1) * R, skipped=cells * (l - 1) * R - passed, start=start, accelerate=accelerate)
+
+        return P[(1, length)].get(compiled.index.get("S"), float("-inf")), Packed_Table(rules, words, table)
     
     
+    # Alias-table sampler over the current rule probabilities, built on
+    # first use and dropped whenever estimate() changes them
+    def sampler(self):
+        if self.rule_sampler is None:
+            self.rule_sampler = Grammar_Sampler(self.grammar, self.q)
+        return self.rule_sampler
+
     def gen_sentence(self, symbol):
-        tokens = []
-        for A, w in self.grammar.unary_rules:
-            if A == symbol:
-                num = int(self.q.get((A, w)) * 1000)
-                for _ in range(num):
-                    tokens.append(w)
-        for A, B, C in self.grammar.binary_rules:
-            if A == symbol:
-                num = int(self.q.get((A, B, C)) * 1000)
-                for _ in range(num):
-                    tokens.append(tuple([B, C]))
-        inx = int(random.uniform(0, len(tokens)))
-        next_symbol = tokens[inx]
-        if isinstance(next_symbol, tuple):
-            return (
-                self.gen_sentence(next_symbol[0])
-                + " "
-                + self.gen_sentence(next_symbol[1])
-            )
-        else:
-            return next_symbol
\ No newline at end of file
+        return self.sampler().sample(symbol)[0]
+
+    # count sentences drawn with a fixed seed, as a generator; with
+    # derivations=True each comes as (sentence, rules used)
+    def gen_sentences(self, count, symbol="S", seed=None, derivations=False):
+        return self.sampler().sentences(count, symbol, seed, derivations)
@@ -0,0 +1,74 @@
+import random
+
+
+class Alias_Table:
+    # Walker's alias method (Vose's build): after O(k) preprocessing each
+    # draw among k weighted outcomes costs one uniform number
+    def __init__(self, outcomes, weights):
+        total = float(sum(weights))
+        if total <= 0:
+            raise ValueError("Alias table needs a positive total weight")
+
+        k = len(outcomes)
+        self.outcomes = list(outcomes)
+        self.accept = [weight * k / total for weight in weights]
+        self.alias = list(range(k))
+
+        small = [i for i, p in enumerate(self.accept) if p < 1]
+        large = [i for i, p in enumerate(self.accept) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.alias[s] = l
+            self.accept[l] -= 1 - self.accept[s]
+            (small if self.accept[l] < 1 else large).append(l)
+        # Leftovers are 1 up to rounding
+        for i in small + large:
+            self.accept[i] = 1.0
+
+    def draw(self, rng):
+        u = rng.random() * len(self.outcomes)
+        i = int(u)
+        return self.outcomes[i] if u - i < self.accept[i] else self.outcomes[self.alias[i]]
+
+
+class Grammar_Sampler:
+    # One alias table per nonterminal over its rules, weighted by q. Rules of
+    # probability 0 are never drawn, any positive probability can be.
+    def __init__(self, grammar, q):
+        rules = {}
+        for A, w in grammar.unary_rules:
+            rules.setdefault(A, []).append((A, w))
+        for A, B, C in grammar.binary_rules:
+            rules.setdefault(A, []).append((A, B, C))
+
+        self.tables = {}
+        for A, options in rules.items():
+            weights = [q.get(rule, 0) for rule in options]
+            if sum(weights) > 0:
+                self.tables[A] = Alias_Table(options, weights)
+
+    # Words derived from symbol and the rules used, in leftmost order; the
+    # derivation is expanded with an explicit stack
+    def sample(self, symbol, rng=random):
+        words, derivation = [], []
+        stack = [symbol]
+        while stack:
+            A = stack.pop()
+            if A not in self.tables:
+                raise ValueError(f"No rule with positive probability expands {A}")
+            rule = self.tables[A].draw(rng)
+            derivation.append(rule)
+            if len(rule) == 2:
+                words.append(rule[1])
+            else:
+                stack.append(rule[2])
+                stack.append(rule[1])
+        return " ".join(words), derivation
+
+    # count sentences from symbol, reproducible for a given seed; with
+    # derivations=True each comes with its rules as (sentence, derivation)
+    def sentences(self, count, symbol="S", seed=None, derivations=False):
+        rng = random.Random(seed)
+        for _ in range(count):
+            sentence, derivation = self.sample(symbol, rng)
+            yield (sentence, derivation) if derivations else sentence
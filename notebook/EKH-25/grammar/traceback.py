@@ -0,0 +1,77 @@
+from abc import abstractmethod
+from collections.abc import Mapping
+
+
+# Backpointer of a cell that derives its word through a unary rule
+LEAF = -1
+
+
+class Parse_Table(Mapping):
+    # Read side shared by the parse tables. children(i, j, A) gives the split
+    # k and the child nonterminals (k, B, C) of a binary cell, None for a
+    # cell that derives its word, and raises KeyError for a cell that was
+    # not built. The older (i, j, A) -> [(i, k, B), (k + 1, j, C)] queries
+    # are answered from it.
+    @abstractmethod
+    def children(self, i, j, A):
+        ...
+
+    def __getitem__(self, key):
+        i, j, X = key
+        try:
+            children = self.children(i, j, X)
+        except KeyError:
+            if i == j and 1 <= i <= len(self.words) and self.words[i - 1] == X:
+                return []
+            raise
+
+        if children is None:
+            return [(i, i, self.words[i - 1])]
+        k, B, C = children
+        return [(i, k, B), (k + 1, j, C)]
+
+    # Dot-bracket string of the parse of words start..end rooted at root,
+    # read with an explicit stack: B leaves open a pair, E leaves close it
+    # and any other leaf is unpaired
+    def structure(self, start=1, end=None, root="S"):
+        end = len(self.words) if end is None else end
+        if end < start:
+            return ""
+
+        chars = []
+        stack = [(start, end, root)]
+        while stack:
+            i, j, A = stack.pop()
+            children = self.children(i, j, A)
+            if children is None:
+                chars.append("(" if A.startswith("B") else ")" if A.startswith("E") else ".")
+            else:
+                k, B, C = children
+                stack.append((k + 1, j, C))
+                stack.append((i, k, B))
+        return "".join(chars)
+
+
+class Packed_Table(Parse_Table):
+    # Backpointers of the dict engine, one int per built cell: LEAF, or
+    # split * len(rules) + rule id into the grammar's binary rules
+    def __init__(self, rules, words, back):
+        self.rules = rules
+        self.words = words
+        self.back = back
+
+    def children(self, i, j, A):
+        packed = self.back[(i, j, A)]
+        if packed == LEAF:
+            return None
+        k, r = divmod(packed, len(self.rules))
+        _, B, C = self.rules[r]
+        return k, B, C
+
+    def __iter__(self):
+        yield from self.back
+        for i, w in enumerate(self.words, 1):
+            yield (i, i, w)
+
+    def __len__(self):
+        return len(self.back) + len(self.words)
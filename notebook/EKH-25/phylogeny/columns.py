@@ -0,0 +1,69 @@
+from collections import OrderedDict
+
+
+class Column_Index:
+    # Distinct columns of an alignment with the first and last position
+    # each occurs at. Tables over any tuple of leaves are projected from the
+    # distinct full columns once and then answer lookups in O(1).
+    def __init__(self, input_sequences):
+        self.sequences = input_sequences
+        self.names = list(input_sequences)
+        self.length = len(input_sequences[self.names[0]]) if self.names else 0
+
+        self.first, self.last = {}, {}
+        for position in range(self.length):
+            column = tuple(input_sequences[name][position] for name in self.names)
+            self.first.setdefault(column, position)
+            self.last[column] = position
+
+        self.tables = {}
+
+    # partial column over leaves -> (first position, last position)
+    def table(self, leaves):
+        leaves = tuple(leaves)
+        if leaves not in self.tables:
+            rows = [self.names.index(name) for name in leaves]
+            table = {}
+            for column, first in self.first.items():
+                partial = tuple(column[row] for row in rows)
+                if partial in table:
+                    known_first, known_last = table[partial]
+                    table[partial] = (min(known_first, first), max(known_last, self.last[column]))
+                else:
+                    table[partial] = (first, self.last[column])
+            self.tables[leaves] = table
+        return self.tables[leaves]
+
+    def occurs(self, column, leaves):
+        return tuple(column) in self.table(leaves)
+
+    # Whether left occurs at some position before some occurrence of right
+    def before(self, left, right, leaves):
+        table = self.table(leaves)
+        left, right = tuple(left), tuple(right)
+        return left in table and right in table and table[left][0] < table[right][1]
+
+    # Single columns hold one nucleotide per leaf; paired columns hold one
+    # nucleotide pair per leaf and need their left half before their right
+    def check(self, column, leaves):
+        if len(column[0]) == 1:
+            return self.occurs(column, leaves)
+        left = tuple(pair[0] for pair in column)
+        right = tuple(pair[1] for pair in column)
+        return self.before(left, right, leaves)
+
+
+indexes = OrderedDict()
+
+
+# Index of an alignment, built once and shared by every caller that passes
+# the same sequences
+def column_index(input_sequences, maxsize=16):
+    key = tuple(input_sequences.items())
+    if key in indexes:
+        indexes.move_to_end(key)
+    else:
+        indexes[key] = Column_Index(input_sequences)
+        if len(indexes) > maxsize:
+            indexes.popitem(last=False)
+    return indexes[key]
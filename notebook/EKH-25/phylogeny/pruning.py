@@ -0,0 +1,241 @@
+import numpy as np
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
+from phylogeny.transition import transition_cache, gap_marginalization
+from phylogeny.columns import column_index
+
+
+NUCLEOTIDES = ["A", "C", "G", "U"]
+TIPS = NUCLEOTIDES + ["-"]
+
+
+class Substitution_Model:
+    # Rate matrix, root frequencies and tip alphabet of the single (4-state)
+    # or paired (16-state) model. Tips may hold gaps, which are marginalized.
+    def __init__(self, rate_values, frequencies, paired=False):
+        if paired:
+            self.states = [c1 + c2 for c1 in NUCLEOTIDES for c2 in NUCLEOTIDES]
+            self.tips = [c1 + c2 for c1 in TIPS for c2 in TIPS]
+        else:
+            self.states = list(NUCLEOTIDES)
+            self.tips = list(TIPS)
+        self.paired = paired
+
+        self.rate_matrix = np.array([[rate_values[(i, j)] for j in self.states] for i in self.states], dtype=np.float64)
+        self.frequencies = np.array([frequencies[state] for state in self.states], dtype=np.float64)
+
+        self.gaps = gap_marginalization(self.states, self.tips)
+        self.gap_only = np.array([set(tip) == {"-"} for tip in self.tips])
+
+    def transition(self, time):
+        return transition_cache.transition(self.rate_matrix, time)
+
+    def transitions(self, times):
+        return transition_cache.transitions(self.rate_matrix, times)
+
+    # P(root state -> tip symbol): observed symbols copy the transition
+    # matrix, gapped symbols sum over the nucleotides the gap hides
+    def tip_transition(self, time):
+        tips = self.transition(time) @ self.gaps
+        tips[:, self.gap_only] = 1
+        return tips
+
+
+# Post-order pass over the tree for a batch of columns. tips maps each leaf
+# name to the tip symbol index of every column; the returned array holds
+# the partial likelihood of every column for every state at node.
+def partial_likelihoods(node, model: Substitution_Model, tips):
+    partial = None
+    for child in node.clades:
+        time = child.branch_length or 0
+        if child.is_terminal():
+            up = model.tip_transition(time)[:, tips[child.name]].T
+        else:
+            up = partial_likelihoods(child, model, tips) @ model.transition(time).T
+        partial = up if partial is None else partial * up
+    return partial
+
+
+def column_likelihoods(tree, model: Substitution_Model, tips):
+    # Every branch length of the tree in one batch, so the traversal below
+    # only reads cached transition matrices
+    model.transitions([clade.branch_length or 0 for clade in tree.find_clades()])
+    return partial_likelihoods(tree.root, model, tips) @ model.frequencies
+
+
+# Distinct alignment columns (in leaf order) made only of nucleotides and
+# gaps, with the first and last position each occurs at
+def observed_columns(input_sequences, leaf_order):
+    symbol = {tip: i for i, tip in enumerate(TIPS)}
+    table = column_index(input_sequences).table(leaf_order)
+
+    columns = [column for column in table if all(char in symbol for char in column)]
+    columns.sort(key=lambda column: [symbol[char] for char in column])
+    codes = np.array([[symbol[char] for char in column] for column in columns], dtype=np.intp)
+    codes = codes.reshape(len(columns), len(leaf_order))
+    return (
+        columns,
+        codes,
+        np.array([table[column][0] for column in columns], dtype=np.intp),
+        np.array([table[column][1] for column in columns], dtype=np.intp),
+    )
+
+
+# Index pairs (left, right) of distinct columns that can form a paired
+# column, i.e. the left column occurs before the right one, ordered by
+# their paired tip codes
+def paired_candidates(codes, first, last):
+    left, right = np.nonzero(first[:, None] < last[None, :])
+    paired_codes = codes[left] * len(TIPS) + codes[right]
+    order = np.lexsort(paired_codes.T[::-1])
+    return left[order], right[order], paired_codes[order]
+
+
+class Likelihood_Cache:
+    # Bounded LRU of paired-column likelihoods keyed by
+    # (tree, model, paired column), shared by every alignment and pass
+    def __init__(self, maxsize=200000):
+        self.maxsize = maxsize
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Keys not cached yet, counting every distinct requested key as a hit
+    # or a miss
+    def missing(self, keys):
+        missing = []
+        for key in dict.fromkeys(keys):
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                missing.append(key)
+        return missing
+
+    def put(self, key, value):
+        self.values[key] = value
+        while len(self.values) > self.maxsize:
+            self.values.popitem(last=False)
+
+    def info(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.values),
+        }
+
+    def clear(self):
+        self.values.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+pair_cache = Likelihood_Cache()
+
+
+class Paired_Columns(Mapping):
+    # Paired-column likelihoods computed on first request. Membership only
+    # checks that the left half occurs before the right half; likelihoods
+    # are computed by the pruning pass for the requested columns alone and
+    # memoized in pair_cache. Iterating lists every feasible pair in the
+    # same order as the eager mapping (and computes all of them).
+    def __init__(self, tree, model: Substitution_Model, input_sequences, leaf_order, cache=pair_cache):
+        self.tree = tree
+        self.model = model
+        self.leaf_order = leaf_order
+        self.index = column_index(input_sequences)
+        self.cache = cache
+        self.key = (tree.format("newick"), model.rate_matrix.tobytes(), model.frequencies.tobytes())
+        self.symbol = {tip: i for i, tip in enumerate(TIPS)}
+
+    def halves(self, column):
+        return tuple(pair[0] for pair in column), tuple(pair[1] for pair in column)
+
+    def __contains__(self, column):
+        if not isinstance(column, tuple) or len(column) != len(self.leaf_order):
+            return False
+        if not all(len(pair) == 2 and pair[0] in self.symbol and pair[1] in self.symbol for pair in column):
+            return False
+        return self.index.before(*self.halves(column), self.leaf_order)
+
+    # Computes the likelihoods of every column not cached yet in one pass
+    def prefetch(self, columns):
+        missing = [key[1] for key in self.cache.missing((self.key, column) for column in columns if column in self)]
+        if not missing:
+            return
+        codes = np.array(
+            [[self.symbol[pair[0]] * len(TIPS) + self.symbol[pair[1]] for pair in column] for column in missing],
+            dtype=np.intp,
+        )
+        tips = {name: codes[:, leaf] for leaf, name in enumerate(self.leaf_order)}
+        for column, likelihood in zip(missing, column_likelihoods(self.tree, self.model, tips)):
+            self.cache.put((self.key, column), float(likelihood))
+
+    def __getitem__(self, column):
+        if (self.key, column) not in self.cache.values:
+            if column not in self:
+                raise KeyError(column)
+            self.prefetch([column])
+        return self.cache.values[(self.key, column)]
+
+    def candidates(self):
+        columns, codes, first, last = observed_columns(self.index.sequences, self.leaf_order)
+        left, right, _ = paired_candidates(codes, first, last)
+        return [tuple(a + b for a, b in zip(columns[l], columns[r])) for l, r in zip(left, right)]
+
+    def __iter__(self):
+        return iter(self.candidates())
+
+    def __len__(self):
+        return len(self.candidates())
+
+    def items(self):
+        candidates = self.candidates()
+        self.prefetch(candidates)
+        return [(column, self[column]) for column in candidates]
+
+
+# Paired-column likelihoods of an alignment, computed on first request
+def lazy_paired_columns(tree, paired_frequencies, paired_rate_values, input_sequences, leaf_order):
+    paired_model = Substitution_Model(paired_rate_values, paired_frequencies, paired=True)
+    return Paired_Columns(tree, paired_model, input_sequences, leaf_order)
+
+
+def get_columns_probability(
+    tree,
+    single_frequencies,
+    paired_frequencies,
+    single_rate_values,
+    paired_rate_values,
+    input_sequences,
+    lazy_pairs=False,
+):
+    leaf_order = [leaf.name for leaf in tree.get_terminals()]
+    columns, codes, first, last = observed_columns(input_sequences, leaf_order)
+
+    single_model = Substitution_Model(single_rate_values, single_frequencies)
+    single_tips = {name: codes[:, leaf] for leaf, name in enumerate(leaf_order)}
+    likelihoods = column_likelihoods(tree, single_model, single_tips)
+
+    single_columns_probability = defaultdict(float)
+    for column, likelihood in zip(columns, likelihoods):
+        single_columns_probability[column] = float(likelihood)
+
+    if lazy_pairs:
+        paired_columns_probability = lazy_paired_columns(tree, paired_frequencies, paired_rate_values, input_sequences, leaf_order)
+        return single_columns_probability, paired_columns_probability, leaf_order
+
+    paired_model = Substitution_Model(paired_rate_values, paired_frequencies, paired=True)
+    left, right, paired_codes = paired_candidates(codes, first, last)
+    paired_tips = {name: paired_codes[:, leaf] for leaf, name in enumerate(leaf_order)}
+    likelihoods = column_likelihoods(tree, paired_model, paired_tips) if len(left) else []
+
+    paired_columns_probability = defaultdict(float)
+    for l, r, likelihood in zip(left, right, likelihoods):
+        column = tuple(a + b for a, b in zip(columns[l], columns[r]))
+        paired_columns_probability[column] = float(likelihood)
+
+    return single_columns_probability, paired_columns_probability, leaf_order
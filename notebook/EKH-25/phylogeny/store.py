@@ -0,0 +1,167 @@
+import os
+import time
+import pickle
+import hashlib
+from io import StringIO
+from collections import OrderedDict
+from Bio import Phylo
+from phylogeny.tree import clade_names_fix
+
+
+# Content-addressed store for the parts of a prediction that do not depend
+# on the hyperparameters: the guide tree of an alignment and its column
+# likelihoods. Entries live in a small in-memory LRU in front of an
+# on-disk LRU of pickles whose total size is bounded; a file's mtime is
+# refreshed on every read and the oldest files are evicted first. The
+# size of the directory is kept in a running index, scanned on the first
+# write and again only when eviction runs.
+class Alignment_Store:
+    def __init__(self, directory="./outputs/store", max_bytes=256 * 2**20, memory_items=64):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        self.files = None
+        self.total = 0
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+
+    # Stable hash of nested tuples / dicts of plain values
+    def key(self, *parts):
+        def canonical(value):
+            if isinstance(value, dict):
+                return tuple(sorted((repr(k), canonical(v)) for k, v in value.items()))
+            if isinstance(value, (tuple, list)):
+                return tuple(canonical(v) for v in value)
+            return repr(value)
+
+        return hashlib.sha256(repr(canonical(parts)).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".pkl")
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits["memory"] += 1
+            return self.memory[key]
+
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                value = pickle.load(file)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return None
+        if self.files is not None and path in self.files:
+            self.files[path] = (time.time_ns(), self.files[path][1])
+
+        self.hits["disk"] += 1
+        self.remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self.remember(key, value)
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+
+        if self.files is None:
+            self.scan()
+        else:
+            size = os.path.getsize(path)
+            self.total += size - self.files.get(path, (0, 0))[1]
+            self.files[path] = (time.time_ns(), size)
+        if self.total > self.max_bytes:
+            self.evict()
+
+    # path -> (last use in ns, size) of every pickle in the directory
+    def scan(self):
+        self.files = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".pkl"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    self.files[path] = (stat.st_mtime_ns, stat.st_size)
+        self.total = sum(size for _, size in self.files.values())
+
+    # Rescans (other processes may share the directory) and removes the
+    # least recently used pickles down to 90% of max_bytes, so a full store
+    # is rescanned once per tenth of its budget written, not on every put
+    def evict(self):
+        self.scan()
+        for path, (_, size) in sorted(self.files.items(), key=lambda item: item[1][0]):
+            if self.total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            del self.files[path]
+            self.total -= size
+
+    def info(self):
+        lookups = self.hits["memory"] + self.hits["disk"] + self.misses
+        return {
+            "memory_hits": self.hits["memory"],
+            "disk_hits": self.hits["disk"],
+            "misses": self.misses,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            "memory_items": len(self.memory),
+            "disk_bytes": self.total if self.files is not None else None,
+        }
+
+    def newick(self, tree):
+        handle = StringIO()
+        Phylo.write(tree, handle, "newick", format_branch_length="%r")
+        return handle.getvalue()
+
+    # Guide tree of an alignment, kept as Newick with full-precision
+    # branch lengths. build() is only called on a miss.
+    def tree(self, input_sequences, builder, build):
+        key = self.key("tree", input_sequences, builder)
+        newick = self.get(key)
+        if newick is None:
+            newick = self.newick(build())
+            self.put(key, newick)
+
+        tree = Phylo.read(StringIO(newick), "newick")
+        clade_names_fix(tree)
+        return tree
+
+    # Single and paired column likelihoods (and leaf order) of an alignment
+    # under a tree and a frequency/rate parameter set. compute() is only
+    # called on a miss and must return eager mappings.
+    def columns_probability(self, tree, parameters, input_sequences, compute):
+        key = self.key("columns", self.newick(tree), parameters, input_sequences)
+
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    # Single column likelihoods and leaf order only, for callers that keep
+    # the paired likelihoods lazy. compute() returns what
+    # get_columns_probability does; its paired part is not stored.
+    def single_columns_probability(self, tree, parameters, input_sequences, compute):
+        key = self.key("single columns", self.newick(tree), parameters, input_sequences)
+
+        value = self.get(key)
+        if value is None:
+            single_columns_probability, _, leaf_order = compute()
+            value = (single_columns_probability, leaf_order)
+            self.put(key, value)
+        return value
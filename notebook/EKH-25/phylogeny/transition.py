@@ -0,0 +1,104 @@
+import numpy as np
+from scipy.linalg import expm
+from collections import OrderedDict
+
+
+class Transition_Cache:
+    # Transition matrices P(t) = exp(Q t) for any number of rate matrices.
+    # Each rate matrix is eigendecomposed once, Q = V diag(w) V^-1, so that
+    # P(t) = V diag(exp(w t)) V^-1 for a whole batch of branch lengths at
+    # once. Matrices are kept in an LRU keyed by (model, t).
+    def __init__(self, maxsize=4096, max_models=64):
+        self.maxsize = maxsize
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.matrices = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Key and decomposition of a rate matrix. Badly conditioned
+    # eigenvectors (close to defective matrices) fall back to expm.
+    def model(self, rate_matrix):
+        key = (rate_matrix.shape[0], rate_matrix.tobytes())
+        if key in self.models:
+            self.models.move_to_end(key)
+            return key, self.models[key]
+
+        w, V = np.linalg.eig(rate_matrix)
+        if np.linalg.cond(V) < 1e8:
+            decomposition = (w, V, np.linalg.inv(V))
+        else:
+            decomposition = None
+
+        self.models[key] = decomposition
+        if len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+        return key, decomposition
+
+    # (len(times), states, states) array of transition matrices
+    def transitions(self, rate_matrix, times):
+        key, decomposition = self.model(rate_matrix)
+        times = [float(t) for t in times]
+        result = np.empty((len(times), rate_matrix.shape[0], rate_matrix.shape[0]))
+
+        missing = []
+        for n, t in enumerate(times):
+            if (key, t) in self.matrices:
+                self.matrices.move_to_end((key, t))
+                result[n] = self.matrices[(key, t)]
+                self.hits += 1
+            else:
+                missing.append(n)
+                self.misses += 1
+
+        if missing:
+            new_times = sorted(set(times[n] for n in missing))
+            if decomposition is None:
+                computed = [expm(rate_matrix * t) for t in new_times]
+            else:
+                w, V, V_inv = decomposition
+                scaled = np.exp(np.multiply.outer(new_times, w))
+                computed = np.einsum("ij,tj,jk->tik", V, scaled, V_inv).real
+
+            for t, P in zip(new_times, computed):
+                self.matrices[(key, t)] = P
+            for n in missing:
+                result[n] = self.matrices[(key, times[n])]
+            while len(self.matrices) > self.maxsize:
+                self.matrices.popitem(last=False)
+
+        return result
+
+    def transition(self, rate_matrix, time):
+        return self.transitions(rate_matrix, [time])[0]
+
+    def info(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.matrices),
+            "models": len(self.models),
+        }
+
+    def clear(self):
+        self.models.clear()
+        self.matrices.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+transition_cache = Transition_Cache()
+
+
+# (states x tips) 0/1 matrix: entry (s, t) is 1 when tip symbol t can hide
+# state s, so P @ gap_marginalization(...) sums the hidden nucleotides of
+# gapped tips. Tips made only of gaps are all ones.
+def gap_marginalization(states, tips):
+    matrix = np.zeros((len(states), len(tips)))
+    for s, state in enumerate(states):
+        for t, tip in enumerate(tips):
+            if all(c == "-" or c == x for c, x in zip(tip, state)):
+                matrix[s, t] = 1
+    return matrix
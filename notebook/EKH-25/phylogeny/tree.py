@@ -0,0 +1,75 @@
+import numpy as np
+from Bio.Phylo.BaseTree import Tree, Clade
+
+
+NUCLEOTIDES = "ACGU"
+
+
+def clade_names_fix(tree):
+    for index, clade in enumerate(tree.find_clades()):
+        if not clade.name:
+            clade.name = str(index)
+
+
+# (sequences x positions) one-hot array of the nucleotides; gaps and any
+# other symbol are all zeros
+def encode_alignment(input_sequences):
+    sequences = [sequence.upper().replace("T", "U") for sequence in input_sequences.values()]
+    codes = np.array([[NUCLEOTIDES.find(char) for char in sequence] for sequence in sequences], dtype=np.intp)
+    return (codes[:, :, None] == np.arange(len(NUCLEOTIDES))).astype(np.float64)
+
+
+# Jukes-Cantor distances over the positions where both sequences hold a
+# nucleotide. Saturated pairs (p >= 3/4) get the largest finite distance.
+def pairwise_distances(input_sequences):
+    encoded = encode_alignment(input_sequences)
+    valid = encoded.sum(2)
+
+    compared = valid @ valid.T
+    matches = np.einsum("ilk,jlk->ij", encoded, encoded)
+    p = np.where(compared > 0, (compared - matches) / np.maximum(compared, 1), 0.75)
+
+    distances = -0.75 * np.log(np.clip(1 - 4 * p / 3, 1e-3, None))
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def neighbor_joining(distances, names):
+    D = np.array(distances, dtype=np.float64)
+    clades = [Clade(name=name) for name in names]
+
+    while len(clades) > 3:
+        n = len(clades)
+        r = D.sum(1)
+        Q = (n - 2) * D - r[:, None] - r[None, :]
+        np.fill_diagonal(Q, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(Q), Q.shape))
+
+        length_i = 0.5 * D[i, j] + (r[i] - r[j]) / (2 * (n - 2))
+        clades[i].branch_length = float(max(length_i, 0))
+        clades[j].branch_length = float(max(D[i, j] - length_i, 0))
+        joined = Clade(clades=[clades[i], clades[j]])
+
+        keep = [k for k in range(n) if k != i and k != j]
+        row = 0.5 * (D[i, keep] + D[j, keep] - D[i, j])
+        D = np.block([[D[np.ix_(keep, keep)], row[:, None]], [row[None, :], np.zeros((1, 1))]])
+        clades = [clades[k] for k in keep] + [joined]
+
+    # The last three clades meet at the (unrooted) center
+    if len(clades) == 3:
+        for a, b, c in [(0, 1, 2), (1, 0, 2), (2, 0, 1)]:
+            clades[a].branch_length = float(max(0.5 * (D[a, b] + D[a, c] - D[b, c]), 0))
+    else:
+        for clade in clades:
+            clade.branch_length = float(D[0, -1] / 2)
+
+    return Tree(root=Clade(clades=clades), rooted=False)
+
+
+# In-process alternative to phyml: neighbor joining on Jukes-Cantor
+# distances, midpoint-rooted and with clades named as clade_names_fix does
+def neighbor_joining_tree(input_sequences):
+    tree = neighbor_joining(pairwise_distances(input_sequences), list(input_sequences))
+    tree.root_at_midpoint()
+    clade_names_fix(tree)
+    return tree
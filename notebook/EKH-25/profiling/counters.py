@@ -0,0 +1,83 @@
+import sys
+import json
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+# Whether the counting code is in the kernels: it sits behind __debug__,
+# which python -O compiles away together with the code it guards
+COMPILED = __debug__
+
+FIELDS = ["cells", "evaluated", "skipped", "start", "accelerate"]
+
+
+class Kernel_Counters:
+    # Work of the parse and inside-outside kernels per kernel and per span
+    # length: cells built, (i, k, j, rule) combinations evaluated, those
+    # skipped because a child is unreachable (the != -inf and nonzero
+    # guards), and $-rule applications scored with the start or the
+    # accelerate ratio. Kernels read enabled once per call and add their
+    # counts once per span length, so the inner loops only bump locals.
+    def __init__(self):
+        self.enabled = False
+        self.spans = defaultdict(lambda: defaultdict(Counter))
+
+    def add(self, kernel, span, **counts):
+        self.spans[kernel][span].update(counts)
+
+    @contextmanager
+    def counting(self):
+        if not COMPILED:
+            raise ValueError("Kernel counters are compiled out (python -O)")
+        enabled, self.enabled = self.enabled, True
+        try:
+            yield self
+        finally:
+            self.enabled = enabled
+
+    # {span: count} of one field
+    def histogram(self, kernel, field="evaluated"):
+        return {span: counts[field] for span, counts in sorted(self.spans[kernel].items())}
+
+    def totals(self, kernel):
+        total = Counter()
+        for counts in self.spans[kernel].values():
+            total.update(counts)
+        return {field: total[field] for field in FIELDS}
+
+    def info(self):
+        return {kernel: self.totals(kernel) for kernel in self.spans}
+
+    def to_json(self):
+        return {
+            kernel: {str(span): {field: counts[field] for field in FIELDS} for span, counts in sorted(spans.items())}
+            for kernel, spans in self.spans.items()
+        }
+
+    # Per-span-length table of every kernel's work, to file (a path or an
+    # open file; stdout by default), or as JSON when the path ends in .json
+    def dump(self, file=None):
+        if isinstance(file, str):
+            with open(file, "w") as handle:
+                if file.endswith(".json"):
+                    json.dump(self.to_json(), handle, indent=2)
+                else:
+                    self.dump(handle)
+            return
+
+        file = file or sys.stdout
+        for kernel, spans in self.spans.items():
+            print(f"{kernel}", file=file)
+            print(f"{'span':>6} " + " ".join(f"{field:>12}" for field in FIELDS) + f" {'skipped %':>10}", file=file)
+            for span, counts in sorted(spans.items()):
+                skipped = 100 * counts["skipped"] / counts["evaluated"] if counts["evaluated"] else 0.0
+                print(f"{span:>6} " + " ".join(f"{counts[field]:>12}" for field in FIELDS) + f" {skipped:>10.1f}", file=file)
+            total = self.totals(kernel)
+            skipped = 100 * total["skipped"] / total["evaluated"] if total["evaluated"] else 0.0
+            print(f"{'total':>6} " + " ".join(f"{total[field]:>12}" for field in FIELDS) + f" {skipped:>10.1f}", file=file)
+
+    def clear(self):
+        self.spans.clear()
+
+
+kernel_counters = Kernel_Counters()
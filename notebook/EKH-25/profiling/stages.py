@@ -0,0 +1,153 @@
+import json
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+from profiling.counters import kernel_counters
+
+
+class Stage_Recorder:
+    # Opt-in timing of the stages of a prediction. A prediction collects
+    # one entry per stage in a list and is emitted as one record to sink,
+    # any callable taking the record (a JSON_Lines_Sink, a Stage_Totals or
+    # a function). tags are copied into every record; the GA sets
+    # "generation" there. memory=True also traces the peak allocation of
+    # every stage, which slows the stages down. While kernel_counters is
+    # counting, every stage also records rule_applications, the (i, k, j,
+    # rule) combinations its kernels evaluated and did not skip.
+    def __init__(self, sink, memory=False, **tags):
+        self.sink = sink
+        self.memory = memory
+        self.tags = tags
+
+    @contextmanager
+    def stage(self, stages, name):
+        record = {"stage": name}
+        tracing = self.memory and tracemalloc.is_tracing()
+        if self.memory:
+            if tracing:
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+
+        counting = kernel_counters.enabled
+        if counting:
+            applied = rules_applied()
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.process_time() - cpu
+            if counting:
+                record["rule_applications"] = rules_applied() - applied
+            if self.memory:
+                record["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                if not tracing:
+                    tracemalloc.stop()
+            stages.append(record)
+
+    def emit(self, stages, **fields):
+        record = {**self.tags, **fields, "stages": stages}
+        record["wall"] = sum(stage["wall"] for stage in stages)
+        record["cpu"] = sum(stage["cpu"] for stage in stages)
+        self.sink(record)
+        return record
+
+
+# Rules and nonterminals of a parser's grammar (a PCNF, or a dense or
+# lattice parser over one)
+def grammar_size(parser):
+    pcfg = getattr(parser, "pcfg", parser)
+    return {
+        "rules": len(pcfg.grammar.unary_rules) + len(pcfg.grammar.binary_rules),
+        "nonterminals": len(pcfg.grammar.nonterminals),
+    }
+
+
+# (i, k, j, rule) combinations the kernels have applied so far, over every
+# kernel and span length of kernel_counters
+def rules_applied():
+    return sum(counts["evaluated"] - counts["skipped"] for spans in kernel_counters.spans.values() for counts in spans.values())
+
+
+# Upper bound on the (i, k, j, rule) combinations a parse of n words
+# applies: every split of every cell for the dict engine, the cells within
+# max_span for the dense and lattice ones (plus the S -> L S cells beyond
+# it). It leaves out the reachability guards, the left-child index of the
+# dict engine and the pair mask, which skip most of them; the applied
+# count is rule_applications, recorded while kernel_counters is counting.
+def max_rule_applications(parser, n):
+    if hasattr(parser, "order"):
+        W = parser.span_limit(n)
+        narrow = sum((n - l + 1) * (l - 1) for l in range(2, W + 1)) * len(parser.order)
+        return narrow + (n - W) * W * len(parser.wide_rules)
+    return (n ** 3 - n) // 6 * len(parser.grammar.binary_rules)
+
+
+# Grammar size and chart work of one parse stage
+def parse_details(parser, table):
+    n = len(table.words)
+    return {
+        **grammar_size(parser),
+        "words": n,
+        "cells": len(table) - n,
+        "max_rule_applications": max_rule_applications(parser, n),
+    }
+
+
+class JSON_Lines_Sink:
+    # Appends each record as one JSON line to filename
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, record):
+        with open(self.filename, "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+
+class Stage_Totals:
+    # In-process sink summing the records per value of the tag key (per GA
+    # generation by default): predictions, and per stage its count, wall
+    # and CPU time, the largest peak and the summed chart work
+    def __init__(self, key="generation"):
+        self.key = key
+        self.totals = defaultdict(lambda: {"predictions": 0, "wall": 0.0, "cpu": 0.0, "stages": {}})
+
+    def __call__(self, record):
+        total = self.totals[record.get(self.key)]
+        total["predictions"] += record.get("predictions", 1)
+        total["wall"] += record["wall"]
+        total["cpu"] += record["cpu"]
+        for stage in record["stages"]:
+            summary = total["stages"].setdefault(stage["stage"], {"count": 0, "wall": 0.0, "cpu": 0.0})
+            summary["count"] += 1
+            summary["wall"] += stage["wall"]
+            summary["cpu"] += stage["cpu"]
+            if "peak_bytes" in stage:
+                summary["peak_bytes"] = max(summary.get("peak_bytes", 0), stage["peak_bytes"])
+            for field in ("cells", "rule_applications", "max_rule_applications"):
+                if field in stage:
+                    summary[field] = summary.get(field, 0) + stage[field]
+
+    def info(self):
+        return {key: dict(total) for key, total in self.totals.items()}
+
+    def clear(self):
+        self.totals.clear()
+
+
+# Sink that passes every record to each of sinks
+def tee(*sinks):
+    def sink(record):
+        for each in sinks:
+            each(record)
+    return sink
+
+
+# Records of a JSON-lines file
+def read_records(filename):
+    with open(filename) as file:
+        return [json.loads(line) for line in file if line.strip()]
@@ -1,17 +1,21 @@
+# Port of EKH-25/grammar/expected_count.py for KH-99, a standalone notebook
+# with its own grammar package: the same counts over KH-99's CFG
+
 from grammar.cfg import CFG
 from collections import defaultdict
-from grammar.inside_outside import Inside_Outside
+from grammar.inside_outside import Array_Inside_Outside
 
 
 class Expected_Count:
-    def __init__(self, sentence, grammar: CFG, q: defaultdict):
+    def __init__(self, sentence, grammar: CFG, q: defaultdict, f=None):
         self.sentence = sentence.split(" ")
         self.n = len(self.sentence)
         self.grammar = grammar
         self.q = q
 
-        self.f = self.init_f()
-        self.io_instance = Inside_Outside(sentence, self.grammar, self.f)
+        # Optional sparse layer of position-specific rule probabilities
+        self.f = f if f is not None else {}
+        self.io_instance = Array_Inside_Outside(sentence, self.grammar, self.q, self.f)
         self.count = self.get_count()
 
     def get_unary_prob(self, A, w):
@@ -20,43 +24,47 @@ class Expected_Count:
     def get_binary_prob(self, A, B, C):
         return self.q.get(tuple([A, B, C]), 0.0)
 
-    def init_f(self):
-        f = defaultdict(float)
-
-        for i in range(1, self.n + 1):
-            for k in range(1, self.n + 1):
-                for j in range(1, self.n + 1):
-                    for A, B, C in self.grammar.binary_rules:
-                        f[tuple([A, B, C, i, k, j])] = self.get_binary_prob(A, B, C)
-
-        for i in range(1, self.n + 1):
-            w = self.sentence[i - 1]
-            for A in self.grammar.nonterminals:
-                if (A, w) in self.grammar.unary_rules:
-                    f[tuple([A, i])] = self.get_unary_prob(A, w)
-                else:
-                    f[tuple([A, i])] = 0.0
-                    # self.q[tuple([A, i])] = 0.0
-        return f
-
     def get_count(self):
         count = defaultdict(float)
+        binary, unary = self.io_instance.get_μ_totals()
 
         for A, B, C in self.grammar.binary_rules:
-            for i in range(1, self.n + 1):
-                for k in range(i, self.n + 1):
-                    for j in range(k + 1, self.n + 1):
-                        count[tuple([A, B, C])] += self.io_instance.get_μ_binary(
-                            A, B, C, i, k, j
-                        )
-
-            count[tuple([A, B, C])] /= self.io_instance.Z
+            count[tuple([A, B, C])] = float(binary[(A, B, C)]) / self.io_instance.Z
 
         for A, w in self.grammar.unary_rules:
-            for i in range(1, self.n + 1):
-                if w == self.sentence[i - 1]:
-                    count[tuple([A, w])] += self.io_instance.get_μ_unary(A, i)
-
-            count[tuple([A, w])] /= self.io_instance.Z
+            count[tuple([A, w])] = float(unary[(A, w)]) / self.io_instance.Z
 
         return count
+
+
+# Expected counts of each sentence under probs, a list of rule
+# probabilities in rules order; None stands for a sentence the grammar
+# cannot parse under them
+def count_sentences(grammar, rules, sentences, probs):
+    q = dict(zip(rules, probs))
+    vectors = []
+    for sentence in sentences:
+        try:
+            count = Expected_Count(sentence, grammar, q).count
+        except ValueError:
+            vectors.append(None)
+            continue
+        vectors.append([count.get(rule) for rule in rules])
+    return vectors
+
+
+# Pool workers keep one copy of the grammar and the corpus for the whole
+# run; each task only ships the current rule probabilities, as a list in
+# unary_rules + binary_rules order, and a shard's bounds. Serial estimation
+# calls count_sentences directly, so the parent never fills this.
+worker_state = {}
+
+
+def init_count_worker(grammar, sentences):
+    worker_state["grammar"] = grammar
+    worker_state["rules"] = grammar.unary_rules + grammar.binary_rules
+    worker_state["sentences"] = sentences
+
+
+def count_shard(probs, start, end):
+    return count_sentences(worker_state["grammar"], worker_state["rules"], worker_state["sentences"][start:end], probs)
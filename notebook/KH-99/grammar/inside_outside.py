@@ -1,85 +1,163 @@
+# Port of EKH-25/grammar/inside_outside.py for KH-99, a standalone notebook
+# with its own grammar package: the same kernels over KH-99's CFG, without
+# the kernel counters, since KH-99 has no profiling package
+
 from grammar.cfg import CFG
+import numpy as np
 from collections import defaultdict
 
 
-class Inside_Outside:
-    def __init__(self, sentence, grammar: CFG, f: defaultdict):
+class Array_Inside_Outside:
+    # Inside-outside over dense (symbol, i, j) arrays. Rule probabilities are
+    # read once per rule from q; f is an optional sparse layer of
+    # position-specific overrides keyed
+    # (A, B, C, i, k, j) for binary and (A, i) for unary rules.
+    def __init__(self, sentence, grammar: CFG, q: defaultdict, f=None):
         self.sentence = sentence.split(" ")
         self.n = len(self.sentence)
         self.grammar = grammar
-        self.f = f
+        self.q = q
+        self.f = f if f is not None else {}
+        self.compile()
         self.inside = self.get_inside_terms()
         self.outside = self.get_outside_terms()
-        self.Z = self.inside["S", 1, self.n]
+        self.Z = float(self.inside[self.index["S"], 0, self.n - 1])
+
+    def compile(self):
+        symbols = list(self.grammar.nonterminals)
+        for A, B, C in self.grammar.binary_rules:
+            symbols += [X for X in (A, B, C) if X not in symbols]
+        self.symbols = symbols
+        self.index = {X: i for i, X in enumerate(symbols)}
+        self.unary_set = set(self.grammar.unary_rules)
+
+        rules = self.grammar.binary_rules
+        self.rule_index = {rule: r for r, rule in enumerate(rules)}
+        self.A = np.array([self.index[A] for A, B, C in rules], dtype=np.intp)
+        self.B = np.array([self.index[B] for A, B, C in rules], dtype=np.intp)
+        self.C = np.array([self.index[C] for A, B, C in rules], dtype=np.intp)
+        self.prob = np.array([self.q.get(tuple([A, B, C]), 0.0) for A, B, C in rules])
+
+        # rule -> symbol incidence matrices used to scatter rule sums
+        self.to_A = np.zeros((len(symbols), len(rules)))
+        self.to_A[self.A, np.arange(len(rules))] = 1.0
+        self.to_B = np.zeros((len(symbols), len(rules)))
+        self.to_B[self.B, np.arange(len(rules))] = 1.0
+        self.to_C = np.zeros((len(symbols), len(rules)))
+        self.to_C[self.C, np.arange(len(rules))] = 1.0
+
+        # sparse overrides grouped by span length j - i
+        self.overrides = defaultdict(list)
+        for key, value in self.f.items():
+            if len(key) == 6 and tuple(key[:3]) in self.rule_index:
+                A, B, C, i, k, j = key
+                if 1 <= i <= k < j <= self.n:
+                    r = self.rule_index[(A, B, C)]
+                    self.overrides[j - i].append((r, i - 1, k - 1, j - 1, value - self.prob[r]))
 
     def get_unary_rule_prob(self, X, i):
-        return self.f.get(tuple([X, i]), 0.0)
+        if tuple([X, i]) in self.f:
+            return self.f[tuple([X, i])]
+        w = self.sentence[i - 1]
+        if tuple([X, w]) in self.unary_set:
+            return self.q.get(tuple([X, w]), 0.0)
+        return 0.0
 
     def get_binary_rule_prob(self, X, Y, Z, i, k, j):
-        return self.f.get(tuple([X, Y, Z, i, k, j]), 0.0)
+        if tuple([X, Y, Z, i, k, j]) in self.f:
+            return self.f[tuple([X, Y, Z, i, k, j])]
+        return self.q.get(tuple([X, Y, Z]), 0.0) if tuple([X, Y, Z]) in self.rule_index else 0.0
+
+    # Index grids for every (i, i + m) left child and (i + m + 1, i + d)
+    # right child of the spans of length d
+    def span_grid(self, d):
+        ii = np.arange(self.n - d)[:, None]
+        mm = np.arange(d)[None, :]
+        return ii, ii + mm, ii + mm + 1, ii + d
 
     def get_inside_terms(self):
-        inside = defaultdict(float)
+        n = self.n
+        inside = np.zeros((len(self.symbols), n, n))
 
-        for i in range(1, 1 + self.n):
-            w = self.sentence[i - 1]
+        for i in range(1, 1 + n):
             for X in self.grammar.nonterminals:
-                if tuple([X, w]) in self.grammar.unary_rules:
-                    inside[X, i, i] = self.get_unary_rule_prob(X, i)
-                else:
-                    inside[X, i, i] = 0.0
-
-        for l in range(1, self.n):
-            for i in range(1, self.n - l + 1):
-                j = i + l
-                for A, B, C in self.grammar.binary_rules:
-                    for k in range(i, j):
-                        if inside[B, i, k] and inside[C, k + 1, j]:
-                            inside[A, i, j] += (
-                                self.get_binary_rule_prob(A, B, C, i, k, j)
-                                * inside[B, i, k]
-                                * inside[C, k + 1, j]
-                            )
-
-        if inside["S", 1, self.n]:
-            return inside
-        else:
-            print(self.sentence)
+                inside[self.index[X], i - 1, i - 1] = self.get_unary_rule_prob(X, i)
 
-    def get_outside_terms(self):
-        outside = defaultdict(float)
+        for d in range(1, n):
+            ii, kk, kk1, jj = self.span_grid(d)
+            paths = (inside[self.B[:, None, None], ii, kk] * inside[self.C[:, None, None], kk1, jj]).sum(2)
+            inside[:, ii[:, 0], ii[:, 0] + d] = self.to_A @ (self.prob[:, None] * paths)
+
+            for r, i, k, j, delta in self.overrides[d]:
+                inside[self.A[r], i, j] += delta * inside[self.B[r], i, k] * inside[self.C[r], k + 1, j]
+
+        # Z = 0 would turn every expected count into 0 / 0
+        if not inside[self.index["S"], 0, n - 1]:
+            raise ValueError(f"Sentence has no parse under the grammar: {' '.join(self.sentence)}")
+        return inside
 
+    def get_outside_terms(self):
         n = self.n
-        outside["S", 1, n] = 1
-        for i in range(1, n + 1):
-            for j in range(n, 0, -1):
-                if i == 1 and j == n:
-                    continue
-                for B, C, A in self.grammar.binary_rules:
-                    for k in range(1, i):
-                        outside[A, i, j] += (
-                            self.get_binary_rule_prob(B, C, A, k, i - 1, j)
-                            * self.inside[C, k, i - 1]
-                            * outside[B, k, j]
-                        )
-                for B, A, C in self.grammar.binary_rules:
-                    for k in range(j + 1, n + 1):
-                        outside[A, i, j] += (
-                            self.get_binary_rule_prob(B, A, C, i, j, k)
-                            * self.inside[C, j + 1, k]
-                            * outside[B, i, k]
-                        )
+        outside = np.zeros((len(self.symbols), n, n))
+        outside[self.index["S"], 0, n - 1] = 1
+
+        # Push each parent span's outside mass down to its children,
+        # longest spans first so every parent is final when it is used
+        for d in range(n - 1, 0, -1):
+            ii, kk, kk1, jj = self.span_grid(d)
+            parent = self.prob[:, None] * outside[self.A[:, None], ii[:, 0], ii[:, 0] + d]
+            left = parent[:, :, None] * self.inside[self.C[:, None, None], kk1, jj]
+            right = parent[:, :, None] * self.inside[self.B[:, None, None], ii, kk]
+            outside[:, ii, kk] += np.tensordot(self.to_B, left, axes=1)
+            outside[:, kk1, jj] += np.tensordot(self.to_C, right, axes=1)
+
+            for r, i, k, j, delta in self.overrides[d]:
+                weight = delta * outside[self.A[r], i, j]
+                outside[self.B[r], i, k] += weight * self.inside[self.C[r], k + 1, j]
+                outside[self.C[r], k + 1, j] += weight * self.inside[self.B[r], i, k]
 
         return outside
 
     def get_μ_unary(self, A, i, j=-1):
         j = i if j == -1 else j
-        return self.inside[A, i, j] * self.outside[A, i, j]
+        if A not in self.index or not (1 <= i <= j <= self.n):
+            return 0.0
+        return self.inside[self.index[A], i - 1, j - 1] * self.outside[self.index[A], i - 1, j - 1]
 
     def get_μ_binary(self, A, B, C, i, k, j):
+        if (A, B, C) not in self.rule_index or not (1 <= i <= k < j <= self.n):
+            return 0.0
         return (
-            self.outside[A, i, j]
+            self.outside[self.index[A], i - 1, j - 1]
             * self.get_binary_rule_prob(A, B, C, i, k, j)
-            * self.inside[B, i, k]
-            * self.inside[C, k + 1, j]
+            * self.inside[self.index[B], i - 1, k - 1]
+            * self.inside[self.index[C], k, j - 1]
         )
+
+    # Expected rule counts (before dividing by Z) for every rule at once
+    def get_μ_totals(self):
+        binary = np.zeros(len(self.prob))
+        for d in range(1, self.n):
+            ii, kk, kk1, jj = self.span_grid(d)
+            paths = (self.inside[self.B[:, None, None], ii, kk] * self.inside[self.C[:, None, None], kk1, jj]).sum(2)
+            binary += self.prob * (self.outside[self.A[:, None], ii[:, 0], ii[:, 0] + d] * paths).sum(1)
+
+            for r, i, k, j, delta in self.overrides[d]:
+                binary[r] += (
+                    delta
+                    * self.outside[self.A[r], i, j]
+                    * self.inside[self.B[r], i, k]
+                    * self.inside[self.C[r], k + 1, j]
+                )
+
+        unary = defaultdict(float)
+        for A, w in self.grammar.unary_rules:
+            for i in range(1, self.n + 1):
+                if w == self.sentence[i - 1]:
+                    unary[(A, w)] += self.get_μ_unary(A, i)
+
+        return {rule: binary[r] for rule, r in self.rule_index.items()}, unary
+
+
+# The name the class had before the array rewrite, so existing imports work
+Inside_Outside = Array_Inside_Outside
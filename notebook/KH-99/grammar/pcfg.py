@@ -2,7 +2,10 @@ import random
 from math import log
 from grammar.cfg import CFG
 from collections import defaultdict
-from grammar.expected_count import Expected_Count
+from multiprocessing import Pool
+from contextlib import nullcontext
+from grammar.expected_count import init_count_worker, count_shard, count_sentences
+from grammar.sampler import Grammar_Sampler
 
 
 class PCFG:
@@ -13,6 +16,8 @@ class PCFG:
         else:
             self.q = self.read_pcfg_file(probablity_file)
 
+        self.rule_sampler = None
+
     def read_pcfg_file(self, filename: str):
         pcfg = []
         with open(filename) as file:
@@ -36,6 +41,19 @@ class PCFG:
                     sentences.append(line.strip())
         return sentences
 
+    # Streams the corpus and collapses identical lines into
+    # (sentence, multiplicity) pairs, in order of first appearance. Unlike
+    # read_train_file, blank lines are dropped: as empty sentences they
+    # have no parse and add nothing to the counts
+    def read_train_corpus(self, filename: str):
+        corpus = {}
+        with open(filename) as f:
+            for line in f:
+                sentence = line.strip()
+                if sentence:
+                    corpus[sentence] = corpus.get(sentence, 0) + 1
+        return list(corpus.items())
+
     def init_q(self):
         q = defaultdict(float)
 
@@ -71,57 +89,84 @@ class PCFG:
                     sum = sum + q[tuple([A, B, C])]
         return q
 
-    def estimate(self, train_file: str, iter_num=20):
+    # workers > 1 computes the expected counts in that many processes. That
+    # only pays off with as many free cores and a corpus whose iterations
+    # take seconds (tens of sentences of 100+ words); otherwise starting
+    # the pool and shipping q every iteration cost more than they save,
+    # which is why estimation is serial by default
+    def estimate(self, train_file: str, iter_num=20, workers=1):
         q = self.q
-        self.sentences = self.read_train_file(train_file)
-
-        for itration in range(1, iter_num + 1):
-            print("Itration number:", itration)
-
-            f = defaultdict(float)
-
-            for A, w in self.grammar.unary_rules:
-                f[tuple([A, w])] = 0.0
+        self.corpus = self.read_train_corpus(train_file)
+        self.sentences = [sentence for sentence, _ in self.corpus]
 
-            for A, B, C in self.grammar.binary_rules:
-                f[tuple([A, B, C])] = 0.0
+        # The pool (None when serial) is terminated when the iterations end
+        # or fail, so no worker outlives estimate()
+        with (Pool(workers, initializer=init_count_worker, initargs=(self.grammar, self.sentences)) if workers > 1 else nullcontext()) as pool:
+            for itration in range(1, iter_num + 1):
+                print("Itration number:", itration)
 
-            for i in range(0, len(self.sentences)):
-                sentence = self.sentences[i]
-                ec_instance = Expected_Count(sentence, self.grammar, q)
-                count = ec_instance.get_count()
+                f = defaultdict(float)
 
                 for A, w in self.grammar.unary_rules:
-                    f[tuple([A, w])] += count.get(tuple([A, w]))
+                    f[tuple([A, w])] = 0.0
+
                 for A, B, C in self.grammar.binary_rules:
-                    f[tuple([A, B, C])] += count.get(tuple([A, B, C]))
-
-            for A in self.grammar.nonterminals:
-                sum_f = 0.0
-                for A2, w in self.grammar.unary_rules:
-                    if A2 == A:
-                        sum_f += f[tuple([A, w])]
-
-                for A2, B, C in self.grammar.binary_rules:
-                    if A2 == A:
-                        sum_f += f[tuple([A, B, C])]
-
-                for A2, w in self.grammar.unary_rules:
-                    if A2 == A and sum_f:
-                        q[tuple([A, w])] = f[tuple([A, w])] / sum_f
-                    if A2 == A and f[tuple([A, w])] == 0.0:
-                        q[tuple([A, w])] = 0.0
-
-                for A2, B, C in self.grammar.binary_rules:
-                    if A2 == A and sum_f:
-                        q[tuple([A, B, C])] = f[tuple([A, B, C])] / sum_f
-                    if A2 == A and f[tuple([A, B, C])] == 0.0:
-                        q[tuple([A, B, C])] = 0.0
+                    f[tuple([A, B, C])] = 0.0
+
+                # Count vectors come back once per unique sentence in corpus order,
+                # so the sums below are the same for any number of workers
+                vectors = self.count_vectors(q, pool, workers)
+                skipped = sum(vector is None for vector in vectors)
+                if skipped:
+                    print("Skipped sentences without a parse:", skipped)
+                for (_, multiplicity), vector in zip(self.corpus, vectors):
+                    if vector is None:
+                        continue
+                    for (A, w), count in zip(self.grammar.unary_rules, vector):
+                        f[tuple([A, w])] += multiplicity * count
+                    for (A, B, C), count in zip(self.grammar.binary_rules, vector[len(self.grammar.unary_rules):]):
+                        f[tuple([A, B, C])] += multiplicity * count
+
+                for A in self.grammar.nonterminals:
+                    sum_f = 0.0
+                    for A2, w in self.grammar.unary_rules:
+                        if A2 == A:
+                            sum_f += f[tuple([A, w])]
+
+                    for A2, B, C in self.grammar.binary_rules:
+                        if A2 == A:
+                            sum_f += f[tuple([A, B, C])]
+
+                    for A2, w in self.grammar.unary_rules:
+                        if A2 == A and sum_f:
+                            q[tuple([A, w])] = f[tuple([A, w])] / sum_f
+                        if A2 == A and f[tuple([A, w])] == 0.0:
+                            q[tuple([A, w])] = 0.0
+
+                    for A2, B, C in self.grammar.binary_rules:
+                        if A2 == A and sum_f:
+                            q[tuple([A, B, C])] = f[tuple([A, B, C])] / sum_f
+                        if A2 == A and f[tuple([A, B, C])] == 0.0:
+                            q[tuple([A, B, C])] = 0.0
+
+        self.rule_sampler = None
 
         print("Estimation complete!")
 
         return q
 
+    # Shards are cut four per worker so that one shard of long sentences
+    # does not keep the other workers idle; starmap returns them in order
+    def count_vectors(self, q, pool, workers):
+        rules = self.grammar.unary_rules + self.grammar.binary_rules
+        probs = [q.get(rule, 0.0) for rule in rules]
+        if pool is None:
+            return count_sentences(self.grammar, rules, self.sentences, probs)
+
+        size = -(-len(self.sentences) // (4 * workers))
+        shards = [(probs, start, min(start + size, len(self.sentences))) for start in range(0, len(self.sentences), size)]
+        return [vector for vectors in pool.starmap(count_shard, shards, chunksize=1) for vector in vectors]
+
     def sentence_prob(self, sentence: str):
         P = defaultdict(float)
         table = defaultdict(None)
@@ -169,25 +214,17 @@ class PCFG:
 
         return P[1, length, "S"], table
 
+    # Alias-table sampler over the current rule probabilities, built on
+    # first use and dropped whenever estimate() changes them
+    def sampler(self):
+        if self.rule_sampler is None:
+            self.rule_sampler = Grammar_Sampler(self.grammar, self.q)
+        return self.rule_sampler
+
     def gen_sentence(self, symbol):
-        tokens = []
-        for A, w in self.grammar.unary_rules:
-            if A == symbol:
-                num = int(self.q.get((A, w)) * 1000)
-                for _ in range(num):
-                    tokens.append(w)
-        for A, B, C in self.grammar.binary_rules:
-            if A == symbol:
-                num = int(self.q.get((A, B, C)) * 1000)
-                for _ in range(num):
-                    tokens.append(tuple([B, C]))
-        inx = int(random.uniform(0, len(tokens)))
-        next_symbol = tokens[inx]
-        if isinstance(next_symbol, tuple):
-            return (
-                self.gen_sentence(next_symbol[0])
-                + " "
-                + self.gen_sentence(next_symbol[1])
-            )
-        else:
-            return next_symbol
+        return self.sampler().sample(symbol)[0]
+
+    # count sentences drawn with a fixed seed, as a generator; with
+    # derivations=True each comes as (sentence, rules used)
+    def gen_sentences(self, count, symbol="S", seed=None, derivations=False):
+        return self.sampler().sentences(count, symbol, seed, derivations)